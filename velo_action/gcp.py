@@ -1,15 +1,60 @@
 import base64
 import binascii
+import enum
+import gzip
+import hashlib
 import json
 import os
-from functools import lru_cache
-from typing import List
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from functools import lru_cache, partial
+from typing import Dict, List
 
-from google.api_core.exceptions import PermissionDenied
+import google_crc32c  # type: ignore
+import requests
+import zstandard  # type: ignore
+from google.api_core.exceptions import FailedPrecondition, PermissionDenied
 from google.auth.exceptions import DefaultCredentialsError
 from google.cloud import secretmanager, storage  # type: ignore
 from google.oauth2 import service_account
 from loguru import logger
+from pydantic import BaseModel
+
+from velo_action.utils import iter_deploy_files
+
+DEFAULT_UPLOAD_CONCURRENCY = 16
+LATEST_SECRET_VERSION = "latest"
+CHECKSUM_CHUNK_SIZE = 1024 * 1024
+# Must be a multiple of 256 KiB. Bounds the memory used by a streaming upload.
+RESUMABLE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Cloud Storage can compose at most 32 objects in one request
+MAX_COMPOSE_COMPONENTS = 32
+ARCHIVE_NAME = "deploy.tar"
+ARCHIVE_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst"}
+
+
+class UploadResult(enum.Enum):
+    SENT = enum.auto()
+    SKIPPED = enum.auto()
+    COPIED = enum.auto()
+
+
+class ArchiveUpload(BaseModel):
+    """Result of uploading the deploy folder as a single archive."""
+
+    name: str
+    members: List[str]
+    size: int
+    uncompressed_size: int
+
+    @property
+    def compression_ratio(self) -> float:
+        if not self.size:
+            return 0.0
+        return self.uncompressed_size / self.size
 
 
 class GCP:
@@ -22,11 +67,17 @@ class GCP:
             logger.info("Using local credentials.")
 
     @lru_cache(maxsize=128)  # noqa: B019
-    def _get_storage_client(self):
+    def _get_storage_client(self, pool_size=DEFAULT_UPLOAD_CONCURRENCY):
         logger.info(f"project {self.project}")
         client = storage.Client(
             credentials=self.scoped_credentials, project=self.project
         )
+        # urllib3 keeps at most 10 connections per host by default. Size the pool
+        # to the number of upload workers so connections are reused, not dropped.
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        client._http.mount("https://", adapter)  # pylint: disable=protected-access
         return client
 
     @lru_cache(maxsize=128)  # noqa: B019
@@ -44,33 +95,259 @@ class GCP:
 
         return secrets_client
 
-    def upload_from_directory(
-        self, path, dest_bucket_name, dest_blob_name
+    def upload_from_directory(  # pylint: disable=too-many-arguments,too-many-locals
+        self,
+        path,
+        dest_bucket_name,
+        dest_blob_name,
+        concurrency=DEFAULT_UPLOAD_CONCURRENCY,
+        incremental=False,
+        reuse_previous=False,
+        composite_threshold=0,
     ) -> List[str]:
-        client = self._get_storage_client()
+        """Upload all files in 'path' to 'dest_blob_name' in the bucket.
+
+        Files matched by the '.veloignore' file in 'path' are left out.
+
+        Files are uploaded by a pool of 'concurrency' workers sharing one
+        connection pool. Failures are collected and raised together once every
+        upload has finished.
+
+        With 'incremental' the objects already under 'dest_blob_name' are listed
+        once, and files with the same checksum as the remote object are skipped.
+
+        With 'reuse_previous' the most recently uploaded version of the project
+        is found from the version prefixes, and only its objects are listed.
+        Files with the same checksum as in that version are copied server-side
+        instead of being uploaded again.
 
-        rel_paths = []
-        for i in path.rglob("*"):
-            rel_paths.append(i)
+        Files larger than 'composite_threshold' bytes are split into chunks that
+        are uploaded in parallel and composed into one object. 0 disables it.
 
+        Returns the uploaded paths relative to 'path'.
+        """
+        client = self._get_storage_client(pool_size=concurrency)
         bucket = client.get_bucket(dest_bucket_name)
 
-        uploaded_files = []
-        for local_file in rel_paths:
-            relative_path = os.path.relpath(local_file, path)
-            remote_path = os.path.join(dest_blob_name, relative_path)
-            if os.path.isfile(local_file):
-                blob = bucket.blob(remote_path)
-                blob.upload_from_filename(local_file)
-                uploaded_files.append(relative_path)
+        remote_index: Dict[str, storage.Blob] = {}
+        previous_index: Dict[str, storage.Blob] = {}
+        if reuse_previous:
+            previous_index = self._previous_index(
+                client, bucket, dest_blob_name, concurrency
+            )
+        if incremental:
+            remote_index = self._remote_index(client, bucket, dest_blob_name)
+
+        upload = partial(
+            _upload_file,
+            bucket,
+            composite_threshold=composite_threshold,
+            composite_parts=min(concurrency, MAX_COMPOSE_COMPONENTS),
+            # Bounds the requests in flight, shared by whole files and the parts
+            # of composite uploads, so parts do not multiply the concurrency.
+            slots=threading.BoundedSemaphore(concurrency),
+        )
+        uploads = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Files are submitted while the folder is walked, so the first
+            # uploads start before the walk has finished.
+            for local_file, relative_path, size in iter_deploy_files(path):
+                future = executor.submit(
+                    upload,
+                    local_file,
+                    os.path.join(dest_blob_name, relative_path),
+                    remote_index.get(relative_path),
+                    previous_index.get(relative_path),
+                )
+                uploads[future] = (relative_path, size)
+            wait(uploads)
+
+        uploaded_files, transferred = _upload_results(
+            uploads, f"{dest_bucket_name}/{dest_blob_name}"
+        )
+        if incremental or reuse_previous:
+            logger.info(
+                f"Sent {transferred[UploadResult.SENT]} bytes, skipped "
+                f"{transferred[UploadResult.SKIPPED]} bytes and copied "
+                f"{transferred[UploadResult.COPIED]} bytes of unchanged files."
+            )
 
         return uploaded_files
 
-    def lookup_data(self, key, project_id, version=None):
+    def upload_archive_from_directory(
+        self, path, dest_bucket_name, dest_blob_name, compression="gzip"
+    ) -> ArchiveUpload:
+        """Upload all files in 'path' as one compressed tar archive.
+
+        Files matched by the '.veloignore' file in 'path' are left out.
+
+        The archive is streamed through a pipe straight into a resumable upload,
+        so nothing is written to disk. A '<archive>.manifest.json' listing the
+        members is uploaded next to it.
+        """
+        if compression not in ARCHIVE_EXTENSIONS:
+            raise ValueError(
+                f"Unknown compression '{compression}'. "
+                f"Use one of {', '.join(ARCHIVE_EXTENSIONS)}."
+            )
+
+        bucket = self._get_storage_client().get_bucket(dest_bucket_name)
+
+        archive_name = ARCHIVE_NAME + ARCHIVE_EXTENSIONS[compression]
+        members: Dict[str, int] = {}
+        errors: List[BaseException] = []
+        read_fd, write_fd = os.pipe()
+
+        writer = threading.Thread(
+            target=_write_archive,
+            args=(write_fd, path, compression, members, errors),
+            daemon=True,
+        )
+        writer.start()
+        with os.fdopen(read_fd, "rb") as pipe:
+            reader = _CountingReader(pipe, errors)
+            blob = bucket.blob(os.path.join(dest_blob_name, archive_name))
+            blob.chunk_size = RESUMABLE_UPLOAD_CHUNK_SIZE
+            try:
+                blob.upload_from_file(reader, content_type="application/x-tar")
+            except Exception:
+                if errors:
+                    raise RuntimeError(
+                        f"Failed to create '{archive_name}'"
+                    ) from errors[0]
+                raise
+            finally:
+                # Closing the read end unblocks the writer if the upload failed.
+                pipe.close()
+                writer.join()
+        if errors:
+            raise RuntimeError(f"Failed to create '{archive_name}'") from errors[0]
+
+        bucket.blob(
+            os.path.join(dest_blob_name, f"{archive_name}.manifest.json")
+        ).upload_from_string(
+            json.dumps(_archive_manifest(archive_name, compression, members)),
+            content_type="application/json",
+        )
+
+        return ArchiveUpload(
+            name=archive_name,
+            members=list(members),
+            size=reader.bytes_read,
+            uncompressed_size=sum(members.values()),
+        )
+
+    @staticmethod
+    def _remote_index(client, bucket, prefix) -> Dict[str, storage.Blob]:
+        """List the objects under 'prefix', keyed by their path relative to it."""
+        blobs = client.list_blobs(
+            bucket,
+            prefix=f"{prefix}/",
+            fields="items(name,size,crc32c,md5Hash,updated),nextPageToken",
+        )
+        return {os.path.relpath(blob.name, prefix): blob for blob in blobs}
+
+    def _previous_index(
+        self, client, bucket, dest_blob_name, concurrency
+    ) -> Dict[str, storage.Blob]:
+        """Index the objects of the version uploaded before 'dest_blob_name'."""
+        project_prefix, version = os.path.split(dest_blob_name)
+        previous_version = self._previous_version(
+            client, bucket, project_prefix, version, concurrency
+        )
+        if not previous_version:
+            return {}
+        logger.info(
+            f"Reusing unchanged artifacts from '{project_prefix}/{previous_version}'"
+        )
+        return self._remote_index(
+            client, bucket, f"{project_prefix}/{previous_version}"
+        )
+
+    @staticmethod
+    def _previous_version(client, bucket, project_prefix, version, concurrency):
+        """Find the most recently uploaded version of the project, except 'version'.
+
+        The versions are listed as prefixes, without their objects. The upload
+        time of a version is taken from one of its objects, looked up in parallel.
+        """
+        listing = client.list_blobs(
+            bucket,
+            prefix=f"{project_prefix}/",
+            delimiter="/",
+            fields="prefixes,nextPageToken",
+        )
+        # The prefixes are collected while the pages are consumed
+        for _ in listing:
+            pass
+        versions = {os.path.basename(prefix.rstrip("/")) for prefix in listing.prefixes}
+        versions.discard(version)
+        if not versions:
+            return None
+
+        def last_updated(candidate):
+            blobs = client.list_blobs(
+                bucket,
+                prefix=f"{project_prefix}/{candidate}/",
+                max_results=1,
+                fields="items(updated)",
+            )
+            return next((blob.updated for blob in blobs), None)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            updated = dict(zip(versions, executor.map(last_updated, versions)))
+        uploaded = [v for v in versions if updated[v] is not None]
+        return max(uploaded, key=updated.get) if uploaded else None
+
+    def lookup_many(self, keys, project_id, enabled_only=False) -> Dict[str, str]:
+        """Resolve several secrets concurrently.
+
+        Returns a dict mapping each key to the secret value.
+        """
+        # Create the client up front, so the workers do not race to create it.
+        self._get_secrets_client()
+
+        def timed_lookup(key):
+            start = time.perf_counter()
+            secret = self.lookup_data(key, project_id, enabled_only=enabled_only)
+            logger.debug(
+                f"Resolved secret '{key}' in {time.perf_counter() - start:.3f}s"
+            )
+            return secret
+
+        unique_keys = list(dict.fromkeys(keys))
+        with ThreadPoolExecutor(max_workers=len(unique_keys) or 1) as executor:
+            secrets = executor.map(timed_lookup, unique_keys)
+            return dict(zip(unique_keys, secrets))
+
+    def lookup_data(self, key, project_id, version=None, enabled_only=False):
+        """Access a secret version.
+
+        Without a 'version' the 'latest' alias is accessed directly, which is a
+        single request. With 'enabled_only', or if the latest version is
+        disabled, the versions are listed to find the highest enabled one.
+        """
         logger.debug(f"Looking for '{key}' in '{project_id}', with version '{version}'")
-        secrets_client = self._get_secrets_client()
         if not version:
-            version = self.get_highest_version(key, project_id)
+            if enabled_only:
+                version = self.get_highest_version(key, project_id, enabled_only=True)
+            else:
+                try:
+                    return self._access_secret_version(
+                        key, project_id, LATEST_SECRET_VERSION
+                    )
+                except FailedPrecondition:
+                    logger.warning(
+                        f"Latest version of secret '{key}' is not enabled. "
+                        "Looking for the highest enabled version."
+                    )
+                    version = self.get_highest_version(
+                        key, project_id, enabled_only=True
+                    )
+        return self._access_secret_version(key, project_id, version)
+
+    def _access_secret_version(self, key, project_id, version):
+        secrets_client = self._get_secrets_client()
         # noinspection PyTypeChecker
         try:
             secret = secrets_client.access_secret_version(
@@ -92,16 +369,20 @@ class GCP:
 
         return secret
 
-    def get_highest_version(self, key, project_id):
+    def get_highest_version(self, key, project_id, enabled_only=False):
         secrets_client = self._get_secrets_client()
         parent = secrets_client.secret_path(project_id, key)
         logger.debug(f"Looking for new version for'{key}' in '{project_id}'")
         logger.debug(f"parent='{parent}'")
         logger.debug("----------------------")
 
+        request = {"parent": parent}
+        if enabled_only:
+            request["filter"] = "state:ENABLED"
+
         highest_found_version = None
         # noinspection PyTypeChecker
-        for version in secrets_client.list_secret_versions(request={"parent": parent}):
+        for version in secrets_client.list_secret_versions(request=request):
             int_v = int(version.name.split("/")[-1])
             if not highest_found_version:
                 highest_found_version = int_v
@@ -131,3 +412,224 @@ class GCP:
         self.scoped_credentials = credentials.with_scopes(
             ["https://www.googleapis.com/auth/cloud-platform"]
         )
+
+
+def _write_archive(write_fd, path, compression, members, errors):
+    """Write the deploy folder as a compressed tar archive into a pipe.
+
+    The size of every member is added to 'members'. A failure is appended to
+    'errors' before the pipe is closed, so the reader sees the error when it
+    reaches the end of the archive.
+    """
+    pipe = os.fdopen(write_fd, "wb")
+    try:
+        with _compressed(pipe, compression) as stream:
+            with tarfile.open(fileobj=stream, mode="w|") as tar:
+                for local_file, relative_path, size in iter_deploy_files(path):
+                    tar.add(local_file, arcname=relative_path)
+                    members[relative_path] = size
+    except BaseException as err:  # pylint: disable=broad-except
+        errors.append(err)
+    finally:
+        pipe.close()
+
+
+def _archive_manifest(archive_name, compression, members) -> dict:
+    """List the members of the archive with their uncompressed size."""
+    return {
+        "archive": archive_name,
+        "compression": compression,
+        "members": [{"path": p, "size": size} for p, size in members.items()],
+    }
+
+
+class _CountingReader:
+    """Wrap a pipe so it can be read by a resumable upload.
+
+    The upload only needs 'tell' to know how far it has read. Reaching the end
+    of the pipe after the writer failed raises, so the upload is never
+    finalized with a truncated archive.
+    """
+
+    def __init__(self, stream, writer_errors):
+        self._stream = stream
+        self._writer_errors = writer_errors
+        self.bytes_read = 0
+
+    def read(self, size=-1) -> bytes:
+        data = self._stream.read(size)
+        # A short read means the end of the pipe was reached
+        if self._writer_errors and (size < 0 or len(data) < size):
+            raise RuntimeError("Writing the archive failed")
+        self.bytes_read += len(data)
+        return data
+
+    def tell(self) -> int:
+        return self.bytes_read
+
+
+class _FileSlice:
+    """A part of a file, read as if it was a file of its own.
+
+    Resumable uploads require the stream to be at position 0 when they start
+    and seek back within it on retries, so positions are relative to 'offset'.
+    """
+
+    def __init__(self, file, offset, length):
+        self._file = file
+        self._offset = offset
+        self._length = length
+        self._file.seek(offset)
+
+    def read(self, size=-1) -> bytes:
+        remaining = self._length - self.tell()
+        if size < 0 or size > remaining:
+            size = remaining
+        return self._file.read(max(size, 0))
+
+    def seek(self, position, whence=os.SEEK_SET) -> int:
+        if whence == os.SEEK_CUR:
+            position += self.tell()
+        elif whence == os.SEEK_END:
+            position += self._length
+        self._file.seek(self._offset + min(max(position, 0), self._length))
+        return self.tell()
+
+    def tell(self) -> int:
+        return self._file.tell() - self._offset
+
+
+@contextmanager
+def _compressed(stream, compression):
+    if compression == "zstd":
+        with zstandard.ZstdCompressor().stream_writer(stream, closefd=False) as writer:
+            yield writer
+    else:
+        with gzip.GzipFile(fileobj=stream, mode="wb") as writer:
+            yield writer
+
+
+def _upload_file(  # pylint: disable=too-many-arguments
+    bucket,
+    local_file,
+    remote_path,
+    existing=None,
+    previous=None,
+    composite_threshold=0,
+    composite_parts=MAX_COMPOSE_COMPONENTS,
+    slots=None,
+) -> UploadResult:
+    """Upload a single file.
+
+    Nothing is uploaded if 'existing' already has the same content. If
+    'previous' has the same content it is copied server-side instead.
+
+    Every request holds one of the 'slots' semaphore while it runs.
+    """
+    slots = slots or nullcontext()
+    if existing is not None and has_same_content(local_file, existing):
+        return UploadResult.SKIPPED
+
+    blob = bucket.blob(remote_path)
+    if previous is not None and has_same_content(local_file, previous):
+        # Large objects may need several rewrite calls to complete.
+        with slots:
+            token, _, _ = blob.rewrite(previous)
+            while token is not None:
+                token, _, _ = blob.rewrite(previous, token=token)
+        return UploadResult.COPIED
+
+    if composite_threshold and os.path.getsize(local_file) > composite_threshold:
+        _composite_upload(bucket, blob, local_file, composite_parts, slots)
+    else:
+        with slots:
+            blob.upload_from_filename(local_file)
+    return UploadResult.SENT
+
+
+def _composite_upload(bucket, blob, local_file, parts, slots):
+    """Upload 'local_file' as 'parts' chunks in parallel and compose them into 'blob'.
+
+    Each part upload holds one of the 'slots' semaphore, the caller does not.
+    The temporary chunk objects are deleted afterwards, also on failure.
+    """
+    size = os.path.getsize(local_file)
+    part_size = -(-size // parts)  # ceil division
+    offsets = range(0, size, part_size)
+    part_blobs = [
+        bucket.blob(f"{blob.name}.velo-part-{i:02d}") for i in range(len(offsets))
+    ]
+
+    def upload_part(part_blob, offset):
+        length = min(part_size, size - offset)
+        with slots, open(local_file, "rb") as file:
+            part_blob.upload_from_file(_FileSlice(file, offset, length), size=length)
+
+    try:
+        with ThreadPoolExecutor(max_workers=len(part_blobs)) as executor:
+            for future in [
+                executor.submit(upload_part, part_blob, offset)
+                for part_blob, offset in zip(part_blobs, offsets)
+            ]:
+                future.result()
+        with slots:
+            blob.compose(part_blobs)
+    finally:
+        bucket.delete_blobs(part_blobs, on_error=lambda _: None)
+
+
+def _upload_results(uploads, destination):
+    """Collect the uploaded paths and the bytes transferred per UploadResult.
+
+    Raises one error listing every failed upload.
+    """
+    uploaded_files = []
+    failed_files: Dict[str, BaseException] = {}
+    transferred = {result: 0 for result in UploadResult}
+    for future, (relative_path, size) in uploads.items():
+        error = future.exception()
+        if error:
+            failed_files[relative_path] = error
+            continue
+        uploaded_files.append(relative_path)
+        transferred[future.result()] += size
+
+    if failed_files:
+        details = "\n".join(f"  {p}: {e}" for p, e in failed_files.items())
+        raise RuntimeError(
+            f"Failed to upload {len(failed_files)} of {len(uploads)} files "
+            f"to '{destination}':\n{details}"
+        )
+    return uploaded_files, transferred
+
+
+def has_same_content(local_file, blob) -> bool:
+    """Compare a local file with a remote object by size and checksum.
+
+    CRC32C is preferred since composite objects do not have an MD5 hash.
+    """
+    if blob.size is not None and blob.size != os.path.getsize(local_file):
+        return False
+    if blob.crc32c:
+        return blob.crc32c == local_crc32c(local_file)
+    if blob.md5_hash:
+        return blob.md5_hash == local_md5(local_file)
+    return False
+
+
+def local_crc32c(local_file) -> str:
+    """Base64 encoded CRC32C of a file, as reported by Cloud Storage."""
+    checksum = google_crc32c.Checksum()
+    with open(local_file, "rb") as file:
+        for chunk in iter(lambda: file.read(CHECKSUM_CHUNK_SIZE), b""):
+            checksum.update(chunk)
+    return base64.b64encode(checksum.digest()).decode("ascii")
+
+
+def local_md5(local_file) -> str:
+    """Base64 encoded MD5 of a file, as reported by Cloud Storage."""
+    md5 = hashlib.md5()
+    with open(local_file, "rb") as file:
+        for chunk in iter(lambda: file.read(CHECKSUM_CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode("ascii")
@@ -1,14 +1,22 @@
 import os
 import sys
+from contextlib import ExitStack, closing
 from pathlib import Path
+from typing import List, Optional
 
 import pydantic
 from loguru import logger
 
 from velo_action import gcp, github
-from velo_action.octopus.client import OctopusClient
-from velo_action.octopus.deployment import Deployment
+from velo_action.octopus.cache import MetadataCache
+from velo_action.octopus.client import (
+    DEFAULT_CONNECT_TIMEOUT,
+    DEFAULT_POOL_SIZE,
+    OctopusClient,
+)
+from velo_action.octopus.deployment import PollingPolicy, fan_out_deployments
 from velo_action.octopus.release import Release
+from velo_action.phases import PhaseGraph
 from velo_action.settings import (
     VELO_TRACE_ID_NAME,
     ActionInputs,
@@ -27,10 +35,202 @@ from velo_action.utils import read_velo_settings
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 VELO_DEPLOY_FOLDER_NAME = ".deploy"
+MB = 1024 * 1024
 LOG_FORMAT = "{time:YYYY-MM-DD HH:mm:ss} {message}"
 
 
-def action(  # pylint: disable=too-many-branches,too-many-locals,too-many-statements
+def start_trace(args: ActionInputs, github_settings: GithubSettings):
+    """Returns the span of the GitHub workflow run, or None if tracing failed"""
+    try:
+        tracer = init_tracer(args, github_settings)
+        return construct_github_action_trace(
+            tracer,
+            args.token,
+            args.preceding_run_ids,
+            github_settings=github_settings,
+        )
+    except Exception as error:  # pylint: disable=broad-except
+        logger.warning(f"Starting trace failed: {error}", exc_info=error)
+        return None
+
+
+def lookup_secrets(args: ActionInputs):
+    gcloud = gcp.GCP(
+        project=args.velo_project, service_account_key=args.service_account_key
+    )
+    secrets = gcloud.lookup_many(
+        [
+            args.octopus_server_secret,
+            args.octopus_api_key_secret,
+            args.velo_artifact_bucket_secret,
+        ],
+        args.velo_project,
+        enabled_only=args.secret_enabled_versions_only,
+    )
+    return gcloud, secrets
+
+
+def create_client(args: ActionInputs, secrets) -> OctopusClient:
+    octopus_server = secrets[args.octopus_server_secret]
+    return OctopusClient(
+        server=octopus_server,
+        api_key=secrets[args.octopus_api_key_secret],
+        auth_token=args.service_account_key,
+        pool_size=max(DEFAULT_POOL_SIZE, args.max_parallel_deployments),
+        timeout=(DEFAULT_CONNECT_TIMEOUT, args.octopus_request_timeout_seconds),
+        retry_budget_seconds=args.octopus_retry_budget_seconds,
+        metadata_cache=(
+            MetadataCache(octopus_server, ttl=args.octopus_metadata_cache_ttl_seconds)
+            if args.octopus_metadata_cache_ttl_seconds
+            else None
+        ),
+        verify=args.octopus_verify_connection,
+    )
+
+
+def upload_artifacts(gcloud, args: ActionInputs, deploy_folder, bucket, blob_name):
+    """Upload the deploy folder below 'blob_name' in the artifact bucket"""
+    if args.artifact_archive:
+        archive = gcloud.upload_archive_from_directory(
+            path=deploy_folder,
+            dest_bucket_name=bucket,
+            dest_blob_name=blob_name,
+            compression=args.artifact_archive,
+        )
+        logger.info(
+            f"Archived {len(archive.members)} release files in '{archive.name}' "
+            f"({archive.size} bytes, compression ratio "
+            f"{archive.compression_ratio:.1f})"
+        )
+        files = archive.members
+    else:
+        files = gcloud.upload_from_directory(
+            path=deploy_folder,
+            dest_bucket_name=bucket,
+            dest_blob_name=blob_name,
+            concurrency=args.upload_concurrency,
+            incremental=args.incremental_upload,
+            reuse_previous=args.reuse_previous_artifacts,
+            composite_threshold=args.composite_upload_threshold_mb * MB,
+        )
+
+    logger.info(
+        f"Uploaded {len(files)} release files to "
+        "'https://console.cloud.google.com/storage/browser/"
+        f"{bucket}/{blob_name}'"
+    )
+    return files
+
+
+def deploy(args: ActionInputs, project, octo: OctopusClient, span):
+    logger.info(f"Deploy to environments: {args.deploy_to_environments}")
+    deploy_vars = {}
+    if span is not None:
+        deploy_vars[VELO_TRACE_ID_NAME] = stringify_span(span)
+
+    tenants: List[Optional[str]] = list(args.tenants)
+    if args.tenant_tags:
+        tagged = octo.lookup_tenants_by_tags(args.tenant_tags)
+        if not tagged:
+            raise ValueError(f"No tenants have the tags {args.tenant_tags}")
+        logger.info(f"Tenants with tags {args.tenant_tags}: {list(tagged)}")
+        tenants += [ten for ten in tagged if ten not in tenants]
+
+    tenants = tenants or [None]
+
+    outcomes = fan_out_deployments(
+        release=Release.from_project_and_version(
+            project_name=project, version=args.version, client=octo
+        ),
+        client=octo,
+        environments=args.deploy_to_environments,  # type: ignore
+        tenants=tenants,
+        wait_seconds=args.wait_for_success_seconds,
+        variables=deploy_vars,
+        max_parallel=args.max_parallel_deployments,
+        polling=PollingPolicy(
+            initial=args.poll_interval_seconds,
+            maximum=args.poll_interval_max_seconds,
+        ),
+        stream_logs=args.stream_deployment_logs,
+    )
+    failed = [o for o in outcomes if o.error]
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(outcomes)} deployments failed: "
+            + ", ".join(f"'{o.environment} {o.tenant or ''}'" for o in failed)
+        )
+
+
+def add_release_phases(  # pylint: disable=too-many-arguments
+    graph: PhaseGraph,
+    args: ActionInputs,
+    github_settings: GithubSettings,
+    deploy_folder,
+    project,
+):
+    """
+    The release is prepared in Octopus Deploy while the artifacts upload, and
+    only created once both are done.
+    """
+
+    def exists(octo):
+        release_exists = Release.exists(
+            project_name=project, version=args.version, client=octo
+        )
+        if release_exists:
+            logger.info(
+                f"Release '{args.version}' already exists at "
+                f"'{octo.baseurl}/app#/Spaces-1/projects/"
+                f"{project}/deployments/releases/{args.version}'. "
+                "If you want to recreate this release, please delete it first in Octopus Deploy."
+                "Project -> Releases -> <Select Release> -> : menu in top right corner -> Delete. "
+            )
+        else:
+            logger.info(
+                f"Creating a release in Octopus Deploy for project '{project}' with version '{args.version}'"
+            )
+        return release_exists
+
+    def upload(found, release_exists):
+        if release_exists:
+            return None
+        gcloud, secrets = found
+        return upload_artifacts(
+            gcloud,
+            args,
+            deploy_folder,
+            secrets[args.velo_artifact_bucket_secret],
+            f"{project}/{args.version}",
+        )
+
+    def prepare(octo, release_exists):
+        if release_exists:
+            return None
+        release = Release(client=octo)
+        payload = release.prepare(
+            project_name=project,
+            project_version=args.version,
+            github_settings=github_settings,
+        )
+        return release, payload
+
+    def create(prepared, _files):
+        if prepared is None:
+            return
+        release, payload = prepared
+        release.submit(payload)
+        logger.info(
+            f"See {release.client.baseurl}/app#/Spaces-1/projects/{project}/deployments/releases/{args.version}"
+        )
+
+    graph.add("release_exists", exists, requires=["client"])
+    graph.add("upload", upload, requires=["secrets", "release_exists"])
+    graph.add("prepare", prepare, requires=["client", "release_exists"])
+    graph.add("release", create, requires=["prepare", "upload"])
+
+
+def action(
     args: ActionInputs,
     github_settings: GithubSettings,
 ) -> ActionOutputs:
@@ -39,8 +239,13 @@ def action(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
     When just generating version it will be run without any inputs.
     Meaning no 'service_account_key'.
     This should not produce an error when initialising the tracing.
+
+    The work is split in phases run as a dependency graph, so that independent
+    phases like tracing and the secret lookup run at the same time.
     """
-    init_trace = False
+    graph = PhaseGraph()
+    # Resources opened by the phases, closed once the graph is done
+    cleanup = ExitStack()
 
     local_debug_mode = pydantic.parse_obj_as(
         bool, os.getenv("LOCAL_DEBUG_MODE", "False")
@@ -49,19 +254,9 @@ def action(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
         # Do not init tracer when action is running without a
         # service_account_key.
         # This is supported behavior when only generating the verison.
-        try:
-            tracer = init_tracer(args, github_settings)
-            span = construct_github_action_trace(
-                tracer,
-                args.token,
-                args.preceding_run_ids,
-                github_settings=github_settings,
-            )
-            trace_id = stringify_span(span)
-            init_trace = True
-        except Exception as error:  # pylint: disable=broad-except
-            trace_id = None
-            logger.warning(f"Starting trace failed: {error}", exc_info=error)
+        graph.add("trace", lambda: start_trace(args, github_settings))
+    else:
+        graph.add("trace", lambda: None)
 
     if args.create_release or args.deploy_to_environments:
         deploy_folder = Path.joinpath(Path(args.workspace), VELO_DEPLOY_FOLDER_NAME)  # type: ignore
@@ -71,97 +266,32 @@ def action(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
             )
 
         os.chdir(args.workspace)  # type: ignore
+        project = read_velo_settings(deploy_folder).project
 
-        gcloud = gcp.GCP(
-            project=args.velo_project, service_account_key=args.service_account_key
-        )
-        octopus_server = gcloud.lookup_data(
-            args.octopus_server_secret, args.velo_project
-        )
-        octopus_api_key = gcloud.lookup_data(
-            args.octopus_api_key_secret, args.velo_project
-        )
-        velo_artifact_bucket = gcloud.lookup_data(
-            args.velo_artifact_bucket_secret, args.velo_project
-        )
-        octo = OctopusClient(
-            server=octopus_server,
-            api_key=octopus_api_key,
-            auth_token=args.service_account_key,
+        graph.add("secrets", lambda: lookup_secrets(args))
+        graph.add(
+            "client",
+            lambda found: cleanup.enter_context(closing(create_client(args, found[1]))),
+            requires=["secrets"],
         )
 
     if args.create_release:
-        release = Release(client=octo)
+        add_release_phases(graph, args, github_settings, deploy_folder, project)
 
-        velo_settings = read_velo_settings(deploy_folder)
-
-        release_exists = release.exists(
-            project_name=velo_settings.project, version=args.version, client=octo
+    if args.deploy_to_environments:
+        graph.add(
+            "deploy",
+            lambda octo, span, *_: deploy(args, project, octo, span),
+            requires=["client", "trace"] + (["release"] if args.create_release else []),
         )
 
-        if release_exists:
-            logger.info(
-                f"Release '{args.version}' already exists at "
-                f"'{release.client.baseurl}/app#/Spaces-1/projects/"
-                f"{velo_settings.project}/deployments/releases/{args.version}'. "
-                "If you want to recreate this release, please delete it first in Octopus Deploy."
-                "Project -> Releases -> <Select Release> -> : menu in top right corner -> Delete. "
-            )
-        else:
-            files = gcloud.upload_from_directory(
-                path=deploy_folder,
-                dest_bucket_name=velo_artifact_bucket,
-                dest_blob_name=f"{velo_settings.project}/{args.version}",
-            )
-
-            logger.info(
-                f"Uploaded {len(files)} release files to "
-                "'https://console.cloud.google.com/storage/browser/"
-                f"{velo_artifact_bucket}/{velo_settings.project}/{args.version}'"
-            )
-
-            logger.info(
-                f"Creating a release in Octopus Deploy for project '{velo_settings.project}' with version '{args.version}'"
-            )
-            release.create(
-                project_name=velo_settings.project,
-                project_version=args.version,
-                github_settings=github_settings,
-            )
-            logger.info(
-                f"See {release.client.baseurl}/app#/Spaces-1/projects/{velo_settings.project}/deployments/releases/{args.version}"
-            )
+    with cleanup:
+        results = graph.run()
 
-    if args.deploy_to_environments:
-        logger.info(f"Deploy to environments: {args.deploy_to_environments}")
-        deploy_vars = {}
-        if trace_id:
-            deploy_vars[VELO_TRACE_ID_NAME] = trace_id
-
-        tenants = args.tenants or [None]  # type: ignore
-
-        for env in args.deploy_to_environments:
-            for ten in tenants:
-                log = f"Deploying project '{velo_settings.project}' version '{args.version}' to '{env}' "
-                if ten:
-                    log += f"for tenant '{ten}'"
-                logger.info(log)
-
-                deploy = Deployment(
-                    project_name=velo_settings.project,
-                    version=args.version,
-                    client=octo,
-                )
-
-                deploy.create(
-                    env_name=env,
-                    tenant=ten,
-                    wait_seconds=args.wait_for_success_seconds,
-                    variables=deploy_vars,
-                )
-
-    if init_trace and (args.deploy_to_environments or args.create_release):
-        print_trace_link(span)
+    if results["trace"] is not None and (
+        args.deploy_to_environments or args.create_release
+    ):
+        print_trace_link(results["trace"])
 
     output = ActionOutputs(version=args.version)
     # Set outputs in environment to be used by other
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, NamedTuple, Optional
+
+import appdirs
+from loguru import logger
+
+DEFAULT_METADATA_CACHE_TTL = 3600
+DEFAULT_LOOKUP_CACHE_SIZE = 1024
+DEFAULT_LOOKUP_CACHE_TTL = 600
+
+_MISSING = object()
+
+
+def default_cache_dir() -> Path:
+    """
+    Prefer the runner tool cache, which survives between jobs on self-hosted
+    runners, and fall back to the user cache directory.
+    """
+    tool_cache = os.getenv("RUNNER_TOOL_CACHE")
+    if tool_cache and os.access(tool_cache, os.W_OK):
+        return Path(tool_cache) / "velo-action"
+    return Path(appdirs.user_cache_dir("velo-action"))
+
+
+class CacheEntry(NamedTuple):
+    data: Any
+    fetched_at: float
+    etag: str = ""
+    last_modified: str = ""
+
+    def validators(self) -> dict:
+        """Headers to revalidate the entry with a conditional request"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class MetadataCache:
+    """
+    On-disk cache of rarely changing Octopus resources, keyed by server URL
+
+    Entries younger than 'ttl' seconds are used as they are. Older entries
+    are kept for revalidation with their ETag and Last-Modified headers.
+    """
+
+    def __init__(self, server, ttl=DEFAULT_METADATA_CACHE_TTL, cache_dir=None):
+        self.ttl = ttl
+        server_key = hashlib.sha256(server.encode()).hexdigest()[:16]
+        self.directory = Path(cache_dir or default_cache_dir()) / "octopus" / server_key
+
+    def load(self, path) -> Optional[CacheEntry]:
+        try:
+            with open(self._file(path), encoding="utf-8") as file:
+                return CacheEntry(**json.load(file))
+        except FileNotFoundError:
+            return None
+        except (OSError, TypeError, ValueError) as err:
+            logger.debug(f"Ignoring unreadable cache entry for '{path}': {err}")
+            return None
+
+    def is_fresh(self, entry) -> bool:
+        return time.time() - entry.fetched_at < self.ttl
+
+    def store(self, path, data, etag="", last_modified="") -> CacheEntry:
+        entry = CacheEntry(data, time.time(), etag or "", last_modified or "")
+        file = self._file(path)
+        try:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            # Write a uniquely named sibling file and rename it, so that
+            # concurrent runs and threads never read a partially written entry.
+            with tempfile.NamedTemporaryFile(
+                "w", dir=file.parent, suffix=".tmp", delete=False, encoding="utf-8"
+            ) as out:
+                json.dump(entry._asdict(), out)
+            os.replace(out.name, file)
+        except OSError as err:
+            logger.debug(f"Could not write cache entry for '{path}': {err}")
+        return entry
+
+    def invalidate(self, path):
+        try:
+            self._file(path).unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as err:
+            logger.debug(f"Could not remove cache entry for '{path}': {err}")
+
+    def _file(self, path) -> Path:
+        return self.directory / f"{hashlib.sha256(path.encode()).hexdigest()[:32]}.json"
+
+
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    size: int
+
+
+class LookupCache:
+    """
+    Thread-safe in-memory cache with LRU and TTL eviction
+
+    Concurrent get_or_load calls for the same key run the loader only once,
+    the other callers wait for and share its result.
+    """
+
+    def __init__(self, maxsize=DEFAULT_LOOKUP_CACHE_SIZE, ttl=DEFAULT_LOOKUP_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()  # key -> (expires_at, value)
+        self._loading: dict = {}  # key -> lock held while loading the key
+        self._lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        """Return the cached value for 'key', calling 'loader' to fill a miss"""
+        with self._lock:
+            value = self._get(key)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                value = self._get(key)
+                if value is not _MISSING:
+                    self.hits += 1
+                    return value
+                self.misses += 1
+            try:
+                value = loader()
+                self.put(key, value)
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+        return value
+
+    def __contains__(self, key) -> bool:
+        with self._lock:
+            return self._get(key) is not _MISSING
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> CacheStats:
+        with self._lock:
+            return CacheStats(self.hits, self.misses, len(self._entries))
+
+    def _get(self, key):
+        """Look up 'key', must be called with the lock held"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return _MISSING
+        self._entries.move_to_end(key)
+        return value
@@ -1,38 +1,109 @@
+import itertools
+import random
+import time
 import urllib.parse
-from functools import lru_cache
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
 
 import requests
 from loguru import logger
-from requests.exceptions import RequestException
-from utils import create_self_signed_jwt, is_valid_gsa_json
+from requests.adapters import HTTPAdapter
+from requests.exceptions import RequestException, Timeout
+from utils import is_valid_gsa_json
+
+from velo_action.octopus.cache import LookupCache, MetadataCache
+from velo_action.tokens import TokenProvider, token_provider
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_BUDGET_SECONDS = 60
+TENANT_PAGE_SIZE = 100
+
+# When to check that the server is reachable. 'lazy' reports it with the
+# first request instead of sending one of its own.
+VERIFY_MODES = ("eager", "lazy", "off")
+
+RETRYABLE_STATUS_CODES = (429, 502, 503, 504)
+IDEMPOTENT_METHODS = ("get", "head")
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 20
+# Allowed difference between the runner's and the Octopus server's clock when
+# looking for a deployment created by a failed request.
+CLOCK_SKEW_ALLOWANCE = timedelta(seconds=30)
 
 
 class OctopusClient:
     baseurl: str = ""
-    _cached_environment_ids: dict = {}
-    _cached_tenant_ids: dict = {}
-    _headers: dict = {}
 
-    def __init__(self, server=None, api_key=None, auth_token=None):
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        server=None,
+        api_key=None,
+        auth_token=None,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=(DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT),
+        max_retries=DEFAULT_MAX_RETRIES,
+        retry_budget_seconds=DEFAULT_RETRY_BUDGET_SECONDS,
+        metadata_cache=None,
+        verify="lazy",
+    ):
+        """
+        All requests share one keep-alive session with up to 'pool_size' open
+        connections. 'timeout' is a (connect, read) tuple in seconds.
+
+        Requests failing with a transient error are retried up to 'max_retries'
+        times, for at most 'retry_budget_seconds' in total.
+
+        Environment, tenant and project lookups go through 'metadata_cache',
+        a MetadataCache, when given.
+
+        'verify' is one of VERIFY_MODES.
+        """
+        if verify not in VERIFY_MODES:
+            raise ValueError(
+                f"verify must be one of {', '.join(VERIFY_MODES)}, not '{verify}'"
+            )
         self.baseurl = server
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_budget_seconds = retry_budget_seconds
+        self._metadata_cache: MetadataCache = metadata_cache
+        self._lookups = LookupCache()
+        self._connected = verify == "off"
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
 
-        # GSA needs to be in JSON in order to create self-signed token
+        self._headers = {"X-Octopus-ApiKey": f"{api_key}"}
+        # GSA needs to be in JSON in order to create self-signed token. The
+        # token is taken per request, so it is refreshed before it expires.
+        self._tokens: Optional[TokenProvider] = None
         if auth_token is not None and is_valid_gsa_json(auth_token):
-            self._headers = {
-                "X-Octopus-ApiKey": f"{api_key}",
-                "Authorization": f"Bearer {create_self_signed_jwt(jwt_content=auth_token, url=server)}",
-            }
+            self._tokens = token_provider(auth_token)
         else:
             logger.warning(
                 "service_account_key needs to be in json. Proceeding without authorization header."
             )
-            self._headers = {"X-Octopus-ApiKey": f"{api_key}"}
 
-        self._verify_connection()
+        if verify == "eager":
+            self._verify_connection()
 
     def base_url(self):
         return self.baseurl
 
+    def close(self):
+        """Close the pooled connections"""
+        stats = self._lookups.stats()
+        logger.debug(
+            f"Lookup cache: {stats.hits} hits, {stats.misses} misses, "
+            f"{stats.size} entries"
+        )
+        self._session.close()
+
     def get(self, path):
         """
         Get a resource
@@ -60,56 +131,365 @@ class OctopusClient:
         """
         return self._request("post", path, data)
 
+    def get_text(self, path, offset=0) -> str:
+        """
+        Get a plain text resource from byte 'offset' onwards
+
+        Asks the server for only the new bytes with a Range header. If the
+        server ignores it, the already seen part is skipped locally.
+        Raises RuntimeError on failure.
+        """
+        url = urllib.parse.urljoin(self.baseurl, path)
+        try:
+            response = self._send(
+                "get", url, headers={"Range": f"bytes={offset}-"} if offset else None
+            )
+        except RequestException as err:
+            raise self._connection_error(url, err) from err
+
+        if response.status_code == 416:  # Range Not Satisfiable, nothing new
+            return ""
+        if response.status_code == 200:
+            content = response.content[offset:]
+        elif response.status_code == 206:
+            content = response.content
+        else:
+            raise RuntimeError(
+                f"GET '{url}' failed with status '{response.status_code}'"
+            )
+        return content.decode("utf-8", errors="replace")
+
+    def get_cached(self, path):
+        """
+        Get a rarely changing resource through the metadata cache
+
+        Fresh entries are returned without a request. Stale entries are
+        revalidated with a conditional request, which costs a 304 response
+        when nothing changed.
+        Raises RuntimeError on failure.
+        """
+        if self._metadata_cache is None:
+            return self.get(path)
+        entry = self._metadata_cache.load(path)
+        if entry is not None and self._metadata_cache.is_fresh(entry):
+            logger.debug(f"Using cached '{path}'")
+            return entry.data
+
+        url = urllib.parse.urljoin(self.baseurl, path)
+        try:
+            response = self._send(
+                "get", url, headers=entry.validators() if entry else None
+            )
+        except RequestException:
+            response = None
+        if response is not None:
+            if response.status_code == 304 and entry is not None:
+                self._metadata_cache.store(
+                    path, entry.data, entry.etag, entry.last_modified
+                )
+                return entry.data
+            if response.status_code == 200:
+                data = response.json()
+                self._metadata_cache.store(
+                    path,
+                    data,
+                    response.headers.get("ETag"),
+                    response.headers.get("Last-Modified"),
+                )
+                return data
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                return self._handle_response(response)
+
+        # Back off, then let the regular request path retry and report the failure
+        time.sleep(self._retry_delay(0, response))
+        data = self.get(path)
+        if data:
+            self._metadata_cache.store(path, data)
+        return data
+
+    def memoize(self, key, loader):
+        """
+        Share the result of 'loader' for 'key' between all callers
+
+        The loader runs once per key, also when called from several threads.
+        Failures are not remembered.
+        """
+        return self._lookups.get_or_load(key, loader)
+
     def lookup_environment_id(self, env_name) -> str:
-        """Translate project name into a project id"""
-        if not self._cached_environment_ids:
-            data = self.get("api/environments/all")
-            self._cached_environment_ids = {e["Name"]: e["Id"] for e in data}
-        if env_name not in self._cached_environment_ids:
-            raise ValueError(f"Environment '{env_name}' is unknown")
-        return self._cached_environment_ids[env_name]
-
-    @lru_cache(maxsize=128)  # noqa: B019
+        """Translate environment name into an environment id"""
+        return self._lookup_by_name("api/environments/all", env_name, "Environment")
+
     def lookup_project_id(self, project_name) -> str:
         """Translate project name into a project id"""
-        pro = self.get(f"api/projects/{project_name}")
-        if not pro:
-            raise ValueError(f"Project '{project_name}' is unknown")
-        return pro["Id"]
+        path = f"api/projects/{project_name}"
+
+        def load():
+            pro = self.get_cached(path)
+            if not pro and self._metadata_cache:
+                self._metadata_cache.invalidate(path)
+                pro = self.get(path)
+            if not pro:
+                raise ValueError(f"Project '{project_name}' is unknown")
+            return pro["Id"]
+
+        return self._lookups.get_or_load(path, load)
 
     def lookup_tenant_id(self, tenant_name) -> str:
-        """Translate tenant name into a tenant id"""
+        """
+        Translate tenant name into a tenant id
+
+        Tenants are searched by name on the server, so only the requested
+        tenant is fetched and cached.
+        """
         if not tenant_name:
             return ""
-        if not self._cached_tenant_ids:
-            data = self.get("api/tenants/all")
-            self._cached_tenant_ids = {e["Name"]: e["Id"] for e in data}
-        if tenant_name not in self._cached_tenant_ids:
+        return self._lookups.get_or_load(
+            f"tenant:{tenant_name}", lambda: self._find_tenant_id(tenant_name)
+        )
+
+    def uncached_tenants(self, tenant_names) -> list:
+        """The tenant names whose ids are not in the lookup cache yet"""
+        return [
+            name
+            for name in tenant_names
+            if name and f"tenant:{name}" not in self._lookups
+        ]
+
+    def warm_up_tenants(self, tenant_names):
+        """
+        Resolve many tenants with one request for all tenants
+
+        Cheaper than searching each tenant when deploying to a large share of
+        them. Only the requested tenants are cached.
+        """
+        wanted = set(tenant_names)
+        for tenant in self.get_cached("api/tenants/all"):
+            if tenant["Name"] in wanted:
+                self._lookups.put(f"tenant:{tenant['Name']}", tenant["Id"])
+
+    def lookup_tenants_by_tags(self, tags) -> tuple:
+        """
+        Find the names of the tenants having the tags
+
+        Tags are canonical 'TagSet/Tag' names. A tenant needs one of the given
+        tags from every tag set. The tenants are fetched with one filtered
+        query, indexed by the tag selection, and their ids are cached for
+        lookup_tenant_id.
+        """
+        tags = sorted(set(tags))
+        return self._lookups.get_or_load(
+            f"tags:{','.join(tags)}", lambda: self._find_tenants_by_tags(tags)
+        )
+
+    def _find_tenants_by_tags(self, tags) -> tuple:
+        names = []
+        for skip in itertools.count(0, TENANT_PAGE_SIZE):
+            query = urllib.parse.urlencode(
+                [("tags", tag) for tag in tags]
+                + [("skip", skip), ("take", TENANT_PAGE_SIZE)]
+            )
+            page = self.get(f"api/tenants?{query}") or {}
+            for tenant in page.get("Items", []):
+                names.append(tenant["Name"])
+                self._lookups.put(f"tenant:{tenant['Name']}", tenant["Id"])
+            if skip + TENANT_PAGE_SIZE >= page.get("TotalResults", 0):
+                break
+        return tuple(names)
+
+    def _find_tenant_id(self, tenant_name) -> str:
+        tenant_id = self._search_tenant(tenant_name, self.get_cached)
+        if tenant_id is None and self._metadata_cache:
+            # The cached search may predate the tenant, search once more
+            tenant_id = self._search_tenant(tenant_name, self._get_uncached)
+        if tenant_id is None:
             raise ValueError(f"Tenant '{tenant_name}' is unknown")
-        return self._cached_tenant_ids[tenant_name]
+        return tenant_id
+
+    @staticmethod
+    def _search_tenant(tenant_name, get):
+        """Page through the tenants whose name contains 'tenant_name'"""
+        for skip in itertools.count(0, TENANT_PAGE_SIZE):
+            query = urllib.parse.urlencode(
+                {"partialName": tenant_name, "skip": skip, "take": TENANT_PAGE_SIZE}
+            )
+            page = get(f"api/tenants?{query}") or {}
+            for tenant in page.get("Items", []):
+                if tenant["Name"] == tenant_name:
+                    return tenant["Id"]
+            if skip + TENANT_PAGE_SIZE >= page.get("TotalResults", 0):
+                return None
+        return None
+
+    def _get_uncached(self, path):
+        self._metadata_cache.invalidate(path)
+        return self.get_cached(path)
+
+    def _lookup_by_name(self, path, name, kind) -> str:
+        def load():
+            return {e["Name"]: e["Id"] for e in self.get_cached(path)}
+
+        ids = self._lookups.get_or_load(path, load)
+        if name not in ids and self._metadata_cache:
+            # The cached list may predate the resource, refetch it once
+            self._metadata_cache.invalidate(path)
+            self._lookups.invalidate(path)
+            ids = self._lookups.get_or_load(path, load)
+        if name not in ids:
+            raise ValueError(f"{kind} '{name}' is unknown")
+        return ids[name]
 
     def _request(self, method, path, data=None):
+        """
+        Send a request, retrying transient failures with exponential backoff.
+
+        GET and HEAD are always retried. POSTs are only retried when
+        _find_created confirms that the failed request did not create the
+        resource anyway.
+        """
         url = urllib.parse.urljoin(self.baseurl, path)
-        try:
-            response = requests.request(method, url, json=data, headers=self._headers)
-            logger.debug(
-                f"{response.request.method} {response.url}: {response.status_code}"
+        deadline = time.monotonic() + self.retry_budget_seconds
+
+        for attempt in itertools.count():
+            started = datetime.now(timezone.utc)
+            response, error = None, None
+            try:
+                response = self._send(method, url, data)
+            except RequestException as err:
+                error = err
+
+            if error is None and response.status_code not in RETRYABLE_STATUS_CODES:
+                return self._handle_response(response)
+
+            delay = self._retry_delay(attempt, response)
+            retry = attempt < self.max_retries and time.monotonic() + delay < deadline
+            if retry and method not in IDEMPOTENT_METHODS:
+                created = self._find_created(method, path, data, started)
+                if created:
+                    return created
+                retry = created is not None
+
+            if not retry:
+                break
+
+            reason = error or f"status {response.status_code}"
+            logger.warning(
+                f"{method.upper()} '{url}' failed with {reason}. "
+                f"Retrying in {delay:.1f} seconds."
             )
-        except RequestException as err:
-            raise RuntimeError(f"Error connecting to '{url}'. Invalid URL?") from err
+            time.sleep(delay)
+
+        if error is not None:
+            raise self._connection_error(url, error) from error
         return self._handle_response(response)
 
-    def _verify_connection(self):
+    def _send(self, method, url, data=None, headers=None):
         try:
-            self._request("head", "api")
-        except requests.RequestException as err:
-            logger.error(
-                "Could not establish connection with Octopus deploy server "
-                f"at '{self.baseurl}'. Failed with '{err}'"
+            response = self._session.request(
+                method,
+                url,
+                json=data,
+                headers={**self._auth_headers(), **(headers or {})},
+                timeout=self.timeout,
+            )
+        except RequestException as err:
+            if not self._connected:
+                logger.error(
+                    "Could not establish connection with Octopus deploy server "
+                    f"at '{self.baseurl}'. Failed with '{err}'"
+                )
+            raise
+        if not self._connected:
+            self._connected = True
+            logger.debug(
+                f"Successfully connected to Octopus deploy server '{self.baseurl}'"
             )
         logger.debug(
-            f"Successfully connected to Octopus deploy server '{self.baseurl}'"
+            f"{response.request.method} {response.url}: {response.status_code}"
         )
+        return response
+
+    def _auth_headers(self) -> dict:
+        if self._tokens is None:
+            return self._headers
+        return {
+            **self._headers,
+            "Authorization": f"Bearer {self._tokens.token(self.baseurl)}",
+        }
+
+    def _connection_error(self, url, err) -> RuntimeError:
+        if isinstance(err, Timeout):
+            return RuntimeError(
+                f"Request to '{url}' timed out after {self.timeout} seconds."
+            )
+        return RuntimeError(f"Error connecting to '{url}'. Invalid URL?")
+
+    @staticmethod
+    def _retry_delay(attempt, response=None) -> float:
+        """Honor 'Retry-After', otherwise back off exponentially with full jitter"""
+        retry_after = None
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                try:
+                    retry_at = parsedate_to_datetime(retry_after)
+                except (TypeError, ValueError):
+                    pass
+                else:
+                    now = datetime.now(timezone.utc)
+                    return max((retry_at - now).total_seconds(), 0.0)
+        cap = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+        return random.uniform(0, cap)
+
+    def _find_created(self, method, path, data, since):
+        """
+        Check whether a failed POST created its resource anyway.
+
+        Returns the created resource, an empty dict if it was confirmed not to
+        exist, or None if it can not be checked and the POST must not be retried.
+        """
+        if method != "post" or not isinstance(data, dict):
+            return None
+        try:
+            if path == "api/releases":
+                response = self._send(
+                    "get",
+                    urllib.parse.urljoin(
+                        self.baseurl,
+                        f"api/projects/{data['ProjectId']}/releases/{data['Version']}",
+                    ),
+                )
+                if response.status_code == 404:
+                    return {}
+                if response.status_code == 200:
+                    return response.json()
+            elif path == "api/deployments":
+                response = self._send(
+                    "get",
+                    urllib.parse.urljoin(
+                        self.baseurl, f"api/releases/{data['ReleaseId']}/deployments"
+                    ),
+                )
+                if response.status_code == 200:
+                    for dep in response.json().get("Items", []):
+                        if (
+                            dep.get("EnvironmentId") == data.get("EnvironmentId")
+                            and dep.get("TenantId") == data.get("TenantId")
+                            and _parse_timestamp(dep["Created"])
+                            >= since - CLOCK_SKEW_ALLOWANCE
+                        ):
+                            return dep
+                    return {}
+        except (RequestException, KeyError, ValueError) as err:
+            logger.debug(f"Could not check if '{path}' was created: {err}")
+        return None
+
+    def _verify_connection(self):
+        """Raises RuntimeError if the server can not be reached"""
+        self._request("head", "api")
 
     @staticmethod
     def _handle_response(response):
@@ -140,3 +520,11 @@ class OctopusClient:
                 f"{response.request.method} '{response.url}' failed with status "
                 f"'{response.status_code}'"
             )
+
+
+def _parse_timestamp(value) -> datetime:
+    """Parse an ISO 8601 timestamp, taking one without an offset as UTC"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed
@@ -1,5 +1,9 @@
 import enum
+import itertools
+import math
+import random
 import typing
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from time import sleep
 
@@ -14,6 +18,66 @@ class DeploymentState(enum.Enum):
     SUCCESS = enum.auto()
     FAIL = enum.auto()
     TIMEOUT = enum.auto()
+    CREATED = enum.auto()
+    SKIPPED = enum.auto()
+
+
+# Deploying to at least this many tenants that are not cached yet resolves them
+# from one list of all tenants instead of searching each by name.
+TENANT_WARM_UP_THRESHOLD = 25
+
+TERMINAL_STATES = (DeploymentState.SUCCESS, DeploymentState.FAIL)
+
+STATE_ERRORS = {
+    DeploymentState.FAIL: "Deployment completed with error",
+    DeploymentState.TIMEOUT: "Time limit exceeded while waiting for deployment",
+}
+
+# Server task states, see
+# https://octopus.com/docs/octopus-rest-api/examples/deployments
+TASK_STATES = {
+    "Success": DeploymentState.SUCCESS,
+    "Failed": DeploymentState.FAIL,
+    "Canceled": DeploymentState.FAIL,
+    "TimedOut": DeploymentState.FAIL,
+}
+
+
+class PollingPolicy(typing.NamedTuple):
+    """
+    Interval between polls while waiting for deployments
+
+    Starts at 'initial' seconds and grows by 'factor' per poll up to 'maximum',
+    with +/- 'jitter' randomisation. With 'use_history' the duration of the last
+    successful deployment to the same project and environment is looked up, and
+    the interval shrinks again as the wait approaches that duration.
+    """
+
+    initial: float = 1.0
+    maximum: float = 30.0
+    factor: float = 1.5
+    jitter: float = 0.1
+    use_history: bool = True
+
+    def interval(self, tick, elapsed, expected=None) -> float:
+        interval = min(self.maximum, self.initial)
+        if self.factor > 1 and 0 < interval < self.maximum:
+            # Stop growing at the maximum, larger powers overflow
+            ticks_to_maximum = math.ceil(math.log(self.maximum / interval, self.factor))
+            interval = min(
+                self.maximum, interval * self.factor ** min(tick, ticks_to_maximum)
+            )
+        if expected is not None:
+            # Poll more often close to the expected completion time
+            interval = min(interval, max(self.initial, abs(expected - elapsed) / 2))
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class DeploymentOutcome(typing.NamedTuple):
+    environment: str
+    tenant: typing.Optional[str]
+    state: DeploymentState
+    error: str = ""
 
 
 class Deployment:
@@ -22,6 +86,10 @@ class Deployment:
 
     def __init__(self, project_name=None, version=None, client=None):
         self.client: OctopusClient = client
+        self._environment_id = ""
+        self._tenant_id = ""
+        self._label = ""
+        self._state = DeploymentState.CREATED
         if project_name and version:
             self._release = Release.from_project_and_version(
                 project_name=project_name, version=version, client=client
@@ -45,7 +113,34 @@ class Deployment:
     def release_id(self) -> str:
         return self._release.id() if self._release else ""
 
-    def create(self, env_name, tenant=None, wait_seconds=0, variables=None):
+    def task_id(self) -> str:
+        return self._octo_object.get("TaskId", "")
+
+    def environment_id(self) -> str:
+        return self._environment_id
+
+    def label(self) -> str:
+        """Environment and tenant name, used to prefix log lines"""
+        return self._label
+
+    def state(self) -> DeploymentState:
+        """Last known state, updated by DeploymentWaiter"""
+        return self._state
+
+    def notify(self, state: DeploymentState):
+        """Called by DeploymentWaiter when the deployment reached a final state"""
+        self._state = state
+        logger.debug(f"Deployment '{self.id()}' finished with state {state.name}")
+
+    def create(  # pylint: disable=too-many-arguments
+        self,
+        env_name,
+        tenant=None,
+        wait_seconds=0,
+        variables=None,
+        polling=None,
+        stream_logs=False,
+    ):
         """
         Deploy the current Release a specific env with an optional tenant
         """
@@ -71,6 +166,9 @@ class Deployment:
             )
 
         self._octo_object = self.client.post("api/deployments", data=payload)
+        self._environment_id = environment_id
+        self._tenant_id = tenant_id
+        self._label = f"{env_name}/{tenant}" if tenant else env_name
 
         logger.info(
             f'Deployment URL: {self.client.base_url()}{self._octo_object["Links"]["Web"]}'
@@ -79,19 +177,33 @@ class Deployment:
         if wait_seconds:
             result = self._wait_until_completed(
                 duration=timedelta(seconds=wait_seconds),
-                environment_id=environment_id,
-                tenant_id=tenant_id,
+                polling=polling,
+                stream_logs=stream_logs,
             )
             if result == DeploymentState.SUCCESS:
                 logger.info("Deployment finished successfully")
             elif result == DeploymentState.FAIL:
-                raise RuntimeError("Deployment completed with error")
+                raise RuntimeError(STATE_ERRORS[result])
             elif result == DeploymentState.TIMEOUT:
-                raise TimeoutError("Time limit exceeded while waiting for deployment")
+                raise TimeoutError(STATE_ERRORS[result])
             else:
                 raise RuntimeError(f"Unexpected state '{result}'")
 
-    def get_state(self, environment_id, tenant_id) -> DeploymentState:
+    def get_state(self, environment_id=None, tenant_id=None) -> DeploymentState:
+        """
+        Current state of the deployment
+
+        Reads the deployment's server task, which is small and constant-size.
+        The project progression is only used if the task is unknown.
+        """
+        if self.task_id():
+            task = self.client.get(f"api/tasks/{self.task_id()}")
+            return TASK_STATES.get(task["State"], DeploymentState.PROGRESS)
+        return self._get_state_from_progression(
+            environment_id or self._environment_id, tenant_id or self._tenant_id
+        )
+
+    def _get_state_from_progression(self, environment_id, tenant_id) -> DeploymentState:
         progression = self.client.get(f"api/projects/{self.project_id()}/progression")
         dep_state = {}
 
@@ -115,12 +227,15 @@ class Deployment:
             if dep_state:
                 break
 
+        if not dep_state:
+            # The deployment is not visible in the progression right after creation
+            return DeploymentState.PROGRESS
         if dep_state["State"] == "Success":
             return DeploymentState.SUCCESS
         if dep_state["State"] in ["Executing", "Queued"]:
             return DeploymentState.PROGRESS
         else:
-            print(dep_state)
+            logger.debug(f"Deployment state: {dep_state}")
             return DeploymentState.FAIL
 
     def _build_form_variables(self, environment_id, variables) -> dict:
@@ -141,29 +256,322 @@ class Deployment:
         return form_variables
 
     def _wait_until_completed(
-        self, duration, environment_id, tenant_id
+        self, duration, polling=None, stream_logs=False
     ) -> DeploymentState:
-        logger.info(f"Waiting up to {duration} for completion...")
-        start = datetime.now()
-
-        while True:
-            state = self.get_state(environment_id=environment_id, tenant_id=tenant_id)
-            if state == DeploymentState.SUCCESS:
-                return state
-            if datetime.now() > start + duration:
-                return DeploymentState.TIMEOUT
-            sleep(1)
+        waiter = DeploymentWaiter(self.client, polling=polling, stream_logs=stream_logs)
+        return waiter.wait([self], duration)[self]
 
     def _variable_name_to_id_mapping(self, environment_id):
-        """
-        Returns mapping of form variable names to their id
+        return variable_name_to_id_mapping(
+            self.client, self.release_id(), environment_id
+        )
 
-        The mapping does also exist in the VariableSet (api/variables/variableset-*)
-        but that endpoint requires additional permissions.
-        """
-        preview = self.client.get(
-            f"api/releases/{self.release_id()}/deployments/preview/{environment_id}"
+
+def variable_name_to_id_mapping(client: OctopusClient, release_id, environment_id):
+    """
+    Returns mapping of form variable names to their id
+
+    The mapping does also exist in the VariableSet (api/variables/variableset-*)
+    but that endpoint requires additional permissions.
+    It is memoized on the client, so all deployments of a release to one
+    environment share one request.
+    """
+
+    def load():
+        preview = client.get(
+            f"api/releases/{release_id}/deployments/preview/{environment_id}"
         )
         form_elements = preview["Form"]["Elements"]
-
         return {e["Control"]["Name"]: e["Name"] for e in form_elements}
+
+    return client.memoize(f"preview:{release_id}:{environment_id}", load)
+
+
+def prefetch_variable_mappings(release: Release, client: OctopusClient, environments):
+    """Fetch the variable mapping of every environment concurrently"""
+    environment_ids = [client.lookup_environment_id(env) for env in environments]
+    with ThreadPoolExecutor(max_workers=len(environment_ids) or 1) as executor:
+        futures = [
+            executor.submit(variable_name_to_id_mapping, client, release.id(), env_id)
+            for env_id in environment_ids
+        ]
+    for future in futures:
+        if future.exception() is not None:
+            # Fetched again, and reported, when deploying to the environment
+            logger.debug(f"Prefetching variable mapping failed: {future.exception()}")
+
+
+class TaskLogTail:
+    """
+    Follows the raw log of a server task
+
+    A byte offset is kept as cursor, so each poll only fetches and prints the
+    lines that were not seen before. Incomplete lines wait for the next poll.
+    """
+
+    def __init__(self, client: OctopusClient, task_id, prefix=""):
+        self.client = client
+        self.task_id = task_id
+        self.prefix = prefix
+        self.offset = 0
+
+    def poll(self, final=False):
+        """Print new log lines. With 'final' an incomplete last line is printed too."""
+        try:
+            text = self.client.get_text(
+                f"api/tasks/{self.task_id}/raw", offset=self.offset
+            )
+        except RuntimeError as err:
+            logger.debug(f"Could not read task log of '{self.task_id}': {err}")
+            return
+
+        if not final:
+            complete, newline, _ = text.rpartition("\n")
+            text = complete + newline
+        self.offset += len(text.encode("utf-8"))
+        for line in text.splitlines():
+            logger.info(f"{self.prefix}{line}")
+
+
+class DeploymentWaiter:
+    """
+    Waits for a set of deployments to complete
+
+    The server tasks of all pending deployments are fetched with one request
+    per tick, and each deployment is notified when it reaches a final state.
+    Deployments without a task fall back to Deployment.get_state.
+    With 'stream_logs' new task log lines are printed on every tick.
+    """
+
+    def __init__(self, client: OctopusClient, polling=None, stream_logs=False):
+        self.client = client
+        self.polling = polling or PollingPolicy()
+        self.stream_logs = stream_logs
+        self._history: typing.Dict[typing.Tuple[str, str], typing.Optional[float]] = {}
+        self._tails: typing.Dict[Deployment, TaskLogTail] = {}
+
+    def wait(
+        self,
+        deployments: typing.List[Deployment],
+        duration: typing.Optional[timedelta] = None,
+        deadlines: typing.Optional[typing.Dict[Deployment, datetime]] = None,
+        first_completed=False,
+    ) -> typing.Dict[Deployment, DeploymentState]:
+        """
+        Wait until the deployments complete or time out
+
+        Every deployment times out after 'duration', or at its own time in
+        'deadlines'. With 'first_completed' it returns as soon as at least one
+        deployment completed. Returns the final state of the completed ones.
+        """
+        start = datetime.now()
+        if deadlines is None:
+            if duration is None:
+                raise ValueError("Either 'duration' or 'deadlines' is required")
+            logger.info(f"Waiting up to {duration} for completion...")
+            deadlines = {dep: start + duration for dep in deployments}
+        pending = list(deployments)
+        results = {}
+
+        if self.stream_logs:
+            for dep in deployments:
+                if dep.task_id() and dep not in self._tails:
+                    # Only prefix the lines when several logs are interleaved
+                    prefix = f"[{dep.label()}] " if len(deployments) > 1 else ""
+                    self._tails[dep] = TaskLogTail(self.client, dep.task_id(), prefix)
+
+        expected = None
+        if self.polling.use_history:
+            known = [d for d in map(self._expected_duration, pending) if d is not None]
+            expected = min(known, default=None)
+
+        for tick in itertools.count():
+            states = self._poll(pending)
+            for dep, polled in states.items():
+                if dep in self._tails:
+                    self._tails[dep].poll(final=polled in TERMINAL_STATES)
+            now = datetime.now()
+            for dep in list(pending):
+                state = states.get(dep)
+                if state not in TERMINAL_STATES and deadlines[dep] <= now:
+                    state = DeploymentState.TIMEOUT
+                if state is not None and (
+                    state in TERMINAL_STATES or state == DeploymentState.TIMEOUT
+                ):
+                    dep.notify(state)
+                    results[dep] = state
+                    pending.remove(dep)
+                    self._tails.pop(dep, None)
+            if not pending or (first_completed and results):
+                return results
+
+            elapsed = (now - start).total_seconds()
+            remaining = min((deadlines[dep] - now).total_seconds() for dep in pending)
+            sleep(min(self.polling.interval(tick, elapsed, expected), remaining))
+        return results
+
+    def _expected_duration(self, deployment) -> typing.Optional[float]:
+        """Duration in seconds of the last successful deployment to the same environment"""
+        key = (deployment.project_id(), deployment.environment_id())
+        if key not in self._history:
+            self._history[key] = None
+            try:
+                tasks = self.client.get(
+                    f"api/tasks?project={key[0]}&environment={key[1]}"
+                    "&name=Deploy&states=Success&take=1"
+                )
+                task = tasks["Items"][0]
+                self._history[key] = (
+                    datetime.fromisoformat(task["CompletedTime"])
+                    - datetime.fromisoformat(task["StartTime"])
+                ).total_seconds()
+            except (RuntimeError, LookupError, TypeError, ValueError) as err:
+                logger.debug(f"No previous deployment duration found: {err}")
+        return self._history[key]
+
+    def _poll(self, deployments) -> typing.Dict[Deployment, DeploymentState]:
+        by_task = {dep.task_id(): dep for dep in deployments if dep.task_id()}
+        states = {dep: dep.get_state() for dep in deployments if not dep.task_id()}
+        if by_task:
+            tasks = self.client.get(
+                f"api/tasks?ids={','.join(by_task)}&take={len(by_task)}"
+            )
+            for task in tasks["Items"]:
+                if task["Id"] in by_task:
+                    states[by_task[task["Id"]]] = TASK_STATES.get(
+                        task["State"], DeploymentState.PROGRESS
+                    )
+        return states
+
+
+def fan_out_deployments(  # pylint: disable=too-many-arguments
+    release: Release,
+    client: OctopusClient,
+    environments: typing.List[str],
+    tenants: typing.List[typing.Optional[str]],
+    wait_seconds=0,
+    variables=None,
+    max_parallel=1,
+    polling=None,
+    stream_logs=False,
+) -> typing.List[DeploymentOutcome]:
+    """
+    Deploy the release to every tenant in each environment
+
+    The tenants of one environment are deployed concurrently, at most
+    'max_parallel' at a time. When waiting, the next tenant is deployed to as
+    soon as a running deployment completes, and no more tenants are deployed
+    to after a failure. The next environment is only deployed to once every
+    deployment to the current one has completed without errors.
+    Returns the outcome of every environment and tenant combination.
+    """
+    # Populate the lookup caches before the deployments run concurrently
+    for env in environments:
+        client.lookup_environment_id(env)
+    uncached = client.uncached_tenants(tenants)
+    if len(uncached) >= TENANT_WARM_UP_THRESHOLD:
+        client.warm_up_tenants(uncached)
+    for ten in tenants:
+        client.lookup_tenant_id(ten)
+    if variables:
+        prefetch_variable_mappings(release, client, environments)
+
+    waiter = DeploymentWaiter(client, polling=polling, stream_logs=stream_logs)
+    outcomes: typing.List[DeploymentOutcome] = []
+    failed = False
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        for env in environments:
+            if failed:
+                outcomes.extend(
+                    DeploymentOutcome(env, ten, DeploymentState.SKIPPED)
+                    for ten in tenants
+                )
+                continue
+            env_outcomes = _deploy_environment(
+                release,
+                client,
+                env,
+                tenants,
+                executor,
+                waiter,
+                wait_seconds,
+                variables,
+                max_parallel,
+            )
+            failed = any(o.error for o in env_outcomes)
+            outcomes.extend(env_outcomes)
+
+    logger.info("Deployment summary:")
+    for outcome in outcomes:
+        line = f"  {outcome.environment} {outcome.tenant or ''}: {outcome.state.name}"
+        if outcome.error:
+            line += f" ({outcome.error})"
+        logger.info(line)
+
+    return outcomes
+
+
+def _deploy_environment(  # pylint: disable=too-many-arguments,too-many-locals
+    release, client, env, tenants, executor, waiter, wait_seconds, variables, window
+) -> typing.List[DeploymentOutcome]:
+    """Deploy to the tenants of one environment, at most 'window' running at once"""
+    outcomes: typing.Dict[int, DeploymentOutcome] = {}
+    queue = list(enumerate(tenants))
+    running: typing.Dict[Deployment, int] = {}
+    deadlines: typing.Dict[Deployment, datetime] = {}
+    failed = False
+
+    while True:
+        free = 0 if failed else window - len(running)
+        batch, queue = queue[:free], queue[free:]
+        futures = [
+            (
+                i,
+                executor.submit(
+                    _create_deployment, release, client, env, ten, variables
+                ),
+            )
+            for i, ten in batch
+        ]
+        for i, future in futures:
+            error = future.exception()
+            if error is not None:
+                outcomes[i] = DeploymentOutcome(
+                    env, tenants[i], DeploymentState.FAIL, str(error)
+                )
+                failed = True
+            elif wait_seconds:
+                dep = future.result()
+                running[dep] = i
+                deadlines[dep] = datetime.now() + timedelta(seconds=wait_seconds)
+            else:
+                outcomes[i] = DeploymentOutcome(
+                    env, tenants[i], DeploymentState.CREATED
+                )
+
+        if not running:
+            if failed or not queue:
+                break
+            continue
+
+        states = waiter.wait(list(running), deadlines=deadlines, first_completed=True)
+        for dep, state in states.items():
+            i = running.pop(dep)
+            message = STATE_ERRORS.get(state, "")
+            failed = failed or bool(message)
+            outcomes[i] = DeploymentOutcome(env, tenants[i], state, message)
+
+    for i, ten in queue:
+        outcomes[i] = DeploymentOutcome(env, ten, DeploymentState.SKIPPED)
+    return [outcomes[i] for i in range(len(tenants))]
+
+
+def _create_deployment(release, client, env, tenant, variables) -> Deployment:
+    log = f"Deploying version '{release.version()}' to '{env}' "
+    if tenant:
+        log += f"for tenant '{tenant}'"
+    logger.info(log)
+
+    deploy = Deployment.from_release(release=release, client=client)
+    deploy.create(env_name=env, tenant=tenant, variables=variables)
+    return deploy
@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
 
 from semantic_version import Version
@@ -7,6 +8,9 @@ from velo_action.settings import GithubSettings
 
 _RELEASE_REGEX = r"^(|\+.*)$"
 
+# Maximum number of package versions looked up at the same time
+PACKAGE_LOOKUP_CONCURRENCY = 8
+
 # This name is set in Octopus deploy when creating the StepTemplate
 # https://octopusdeploy.prod.nube.tech/app#/Spaces-1/library/steptemplates/ActionTemplates-1?activeTab=settings
 VELO_BOOTSTRAPPER_ACTION_NAME = "run velo"
@@ -49,7 +53,24 @@ class Release:
         github_settings: GithubSettings,
         auto_select_packages: bool = True,
     ) -> None:
+        payload = self.prepare(
+            project_name, project_version, github_settings, auto_select_packages
+        )
+        self.submit(payload)
 
+    def prepare(
+        self,
+        project_name: str,
+        project_version: str,
+        github_settings: GithubSettings,
+        auto_select_packages: bool = True,
+    ) -> dict:
+        """
+        Build the payload of a new release without creating it
+
+        Resolves the project and the package versions, which does not depend
+        on the release artifacts being uploaded yet.
+        """
         project_id = self.client.lookup_project_id(project_name)
         if auto_select_packages:
             packages = self._determine_latest_deploy_packages(project_id)
@@ -65,6 +86,10 @@ class Release:
         if packages:
             payload["SelectedPackages"] = packages
 
+        return payload
+
+    def submit(self, payload: dict) -> None:
+        """Create the release prepared with 'prepare'"""
         self._octo_object = self.client.post("api/releases", data=payload)
 
     @classmethod
@@ -94,22 +119,42 @@ class Release:
             f"api/projects/{project_id}/deploymentprocesses/template"
         )
 
-        packages = []
-        for pkg in template["Packages"]:
-            ver = self.client.get(
-                f"api/feeds/{pkg['FeedId']}/packages/versions?"
-                f"packageId={pkg['PackageId']}&preReleaseTag={_RELEASE_REGEX}&take=1"
+        # Steps often share a package, look up each one once
+        keys = {(pkg["FeedId"], pkg["PackageId"]) for pkg in template["Packages"]}
+        with ThreadPoolExecutor(
+            max_workers=max(min(PACKAGE_LOOKUP_CONCURRENCY, len(keys)), 1)
+        ) as executor:
+            versions = dict(
+                zip(keys, executor.map(lambda key: self._latest_version(*key), keys))
             )
 
+        packages = []
+        for pkg in template["Packages"]:
             packages.append(
                 {
                     "ActionName": (pkg["ActionName"]),
-                    "Version": ver["Items"][0]["Version"],
+                    "Version": versions[(pkg["FeedId"], pkg["PackageId"])],
                 }
             )
 
         return packages
 
+    def _latest_version(
+        self, feed_id, package_id, pre_release_tag=_RELEASE_REGEX
+    ) -> str:
+        """Highest version of a package, remembered by the client for the run"""
+
+        def load():
+            ver = self.client.get(
+                f"api/feeds/{feed_id}/packages/versions?"
+                f"packageId={package_id}&preReleaseTag={pre_release_tag}&take=1"
+            )
+            return ver["Items"][0]["Version"]
+
+        return self.client.memoize(
+            f"package:{feed_id}:{package_id}:{pre_release_tag}", load
+        )
+
     def list_available_deploy_packages(self) -> List[str]:
         """
         A release needs to specify the version of all deployment steps. We fetch
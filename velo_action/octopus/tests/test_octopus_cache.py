@@ -0,0 +1,227 @@
+# pylint: disable=protected-access
+import gc
+import threading
+import unittest.mock
+import weakref
+
+import pytest
+
+from velo_action.octopus.cache import LookupCache, MetadataCache
+from velo_action.octopus.client import OctopusClient
+from velo_action.octopus.tests.test_decorators import Request, mock_client_requests
+from velo_action.octopus.tests.test_octopus_client import response_mock
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return MetadataCache("https://octopus/", ttl=60, cache_dir=tmp_path)
+
+
+@pytest.fixture
+def octo(cache):
+    return OctopusClient(server="https://octopus/", metadata_cache=cache)
+
+
+def test_cache_is_keyed_by_server(tmp_path):
+    first = MetadataCache("https://octopus-1/", cache_dir=tmp_path)
+    second = MetadataCache("https://octopus-2/", cache_dir=tmp_path)
+    first.store("api/environments/all", [{"Name": "DevEnv", "Id": "env-1"}])
+
+    assert first.load("api/environments/all").data == [
+        {"Name": "DevEnv", "Id": "env-1"}
+    ]
+    assert second.load("api/environments/all") is None
+
+
+def test_cache_entry_expires(cache):
+    entry = cache.store("api/environments/all", [], etag='"v1"')
+    assert cache.is_fresh(entry)
+
+    with unittest.mock.patch("time.time", return_value=entry.fetched_at + 61):
+        assert not cache.is_fresh(entry)
+    assert entry.validators() == {"If-None-Match": '"v1"'}
+
+
+def test_concurrent_stores_leave_no_partial_files(cache):
+    data = [{"Name": f"Env{i}", "Id": f"env-{i}"} for i in range(100)]
+    threads = [
+        threading.Thread(target=cache.store, args=("api/environments/all", data))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert cache.load("api/environments/all").data == data
+    assert [f.suffix for f in cache.directory.iterdir()] == [".json"]
+
+
+def test_cache_ignores_corrupt_entry(cache):
+    cache.store("api/environments/all", [])
+    cache._file("api/environments/all").write_text("{", encoding="utf-8")
+
+    assert cache.load("api/environments/all") is None
+
+
+@unittest.mock.patch(target="requests.Session.request")
+def test_fresh_entry_needs_no_request(request_mock, octo, cache):
+    cache.store("api/environments/all", [{"Name": "DevEnv", "Id": "env-1"}])
+
+    assert octo.lookup_environment_id("DevEnv") == "env-1"
+    request_mock.assert_not_called()
+
+
+@unittest.mock.patch(target="requests.Session.request")
+def test_stale_entry_is_revalidated(request_mock, octo, cache):
+    entry = cache.store(
+        "api/environments/all", [{"Name": "DevEnv", "Id": "env-1"}], etag='"v1"'
+    )
+    request_mock.return_value = response_mock(304)
+
+    with unittest.mock.patch("time.time", return_value=entry.fetched_at + 61):
+        assert octo.get_cached("api/environments/all") == entry.data
+
+    assert request_mock.call_args.kwargs["headers"]["If-None-Match"] == '"v1"'
+    assert cache.is_fresh(cache.load("api/environments/all"))
+
+
+@unittest.mock.patch(target="requests.Session.request")
+def test_cold_fetch_stores_validators(request_mock, octo, cache):
+    request_mock.return_value = response_mock(
+        200,
+        json={"TotalResults": 1, "Items": [{"Name": "TenantName", "Id": "tenant-1"}]},
+        headers={"ETag": '"v2"', "Last-Modified": "Tue, 23 Aug 2022 10:00:00 GMT"},
+    )
+
+    assert octo.lookup_tenant_id("TenantName") == "tenant-1"
+
+    entry = cache.load("api/tenants?partialName=TenantName&skip=0&take=100")
+    assert entry.etag == '"v2"'
+    assert entry.validators()["If-Modified-Since"] == "Tue, 23 Aug 2022 10:00:00 GMT"
+
+
+@unittest.mock.patch(target="requests.Session.request")
+def test_failed_revalidation_is_not_repeated(request_mock, octo, cache):
+    request_mock.return_value = response_mock(
+        403, json={"ErrorMessage": "Access denied"}
+    )
+
+    with pytest.raises(RuntimeError, match="Access denied"):
+        octo.get_cached("api/environments/all")
+    request_mock.assert_called_once()
+
+
+@unittest.mock.patch("velo_action.octopus.client.time.sleep")
+@unittest.mock.patch(target="requests.Session.request")
+def test_transient_revalidation_failure_is_retried(
+    request_mock, sleep_mock, octo, cache
+):
+    request_mock.side_effect = [
+        response_mock(503),
+        response_mock(200, json=[{"Name": "DevEnv", "Id": "env-1"}]),
+    ]
+
+    assert octo.get_cached("api/environments/all") == [
+        {"Name": "DevEnv", "Id": "env-1"}
+    ]
+    sleep_mock.assert_called_once()
+    assert cache.load("api/environments/all").data == [
+        {"Name": "DevEnv", "Id": "env-1"}
+    ]
+
+
+@unittest.mock.patch(target="requests.Session.request")
+def test_unknown_name_refetches_once(request_mock, octo, cache):
+    cache.store("api/environments/all", [{"Name": "DevEnv", "Id": "env-1"}])
+    request_mock.return_value = response_mock(
+        200,
+        json=[
+            {"Name": "DevEnv", "Id": "env-1"},
+            {"Name": "NewEnv", "Id": "env-2"},
+        ],
+    )
+
+    assert octo.lookup_environment_id("NewEnv") == "env-2"
+    with pytest.raises(ValueError, match="is unknown"):
+        octo.lookup_environment_id("UnknownEnv")
+    assert request_mock.call_count == 2
+
+
+def test_lookup_cache_evicts_least_recently_used():
+    lookups = LookupCache(maxsize=2)
+    lookups.put("a", 1)
+    lookups.put("b", 2)
+    assert lookups.get_or_load("a", lambda: 0) == 1
+    lookups.put("c", 3)
+
+    assert lookups.get_or_load("b", lambda: 0) == 0
+    assert lookups.get_or_load("c", lambda: 0) == 3
+    assert lookups.stats() == (2, 1, 2)
+
+
+def test_lookup_cache_expires_entries():
+    lookups = LookupCache(ttl=10)
+    with unittest.mock.patch("time.monotonic", return_value=100):
+        lookups.put("a", 1)
+    with unittest.mock.patch("time.monotonic", return_value=111):
+        assert lookups.get_or_load("a", lambda: 2) == 2
+
+
+def test_lookup_cache_loads_concurrent_misses_once():
+    lookups = LookupCache()
+    loading = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        loading.set()
+        release.wait(5)
+        return "env-1"
+
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(lookups.get_or_load("a", load)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    loading.wait(5)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ["env-1"] * 5
+    assert len(calls) == 1
+    assert lookups.stats().misses == 1
+
+
+def test_lookup_cache_does_not_keep_failures():
+    lookups = LookupCache()
+
+    def fail():
+        raise ValueError("Unknown")
+
+    with pytest.raises(ValueError):
+        lookups.get_or_load("a", fail)
+    assert lookups.get_or_load("a", lambda: 1) == 1
+
+
+@mock_client_requests(
+    [
+        Request("get", "api/projects/ProjectName", response={"Id": "project-1"}),
+        Request("get", "api/projects/ProjectName", response={"Id": "project-2"}),
+    ]
+)
+def test_lookups_are_per_client():
+    first = OctopusClient(server="https://octopus-1/")
+    second = OctopusClient(server="https://octopus-2/")
+
+    assert first.lookup_project_id("ProjectName") == "project-1"
+    assert second.lookup_project_id("ProjectName") == "project-2"
+
+    reference = weakref.ref(first)
+    del first
+    gc.collect()
+    assert reference() is None
@@ -1,37 +1,77 @@
+# pylint: disable=protected-access
 import unittest.mock
+from datetime import datetime, timezone
 
 import pytest
+import requests
 
 from velo_action.octopus.client import OctopusClient
 from velo_action.octopus.tests.test_decorators import Request, mock_client_requests
 
 
 @pytest.fixture
-@mock_client_requests(
-    [
-        Request("head", "api", response=True),
-    ]
-)
 def octo():
     return OctopusClient()
 
 
-@unittest.mock.patch(target="requests.request")
+@unittest.mock.patch(target="requests.Session.request")
 def test_init(request_mock: unittest.mock.Mock):
     request_mock.return_value = unittest.mock.Mock(
         **{"status_code": 200, "request.method": "head"}
     )
 
-    OctopusClient(server="https://octopus/", api_key="ExampleApiKey")
+    OctopusClient(server="https://octopus/", api_key="ExampleApiKey", verify="eager")
 
     request_mock.assert_called_once_with(
         "head",
         "https://octopus/api",
         headers={"X-Octopus-ApiKey": "ExampleApiKey"},
         json=None,
+        timeout=(10, 60),
     )
 
 
+@unittest.mock.patch(target="requests.Session.request")
+def test_init_lazy(request_mock: unittest.mock.Mock):
+    request_mock.return_value = response_mock(200, json={"Id": "project-1"})
+
+    octo = OctopusClient(server="https://octopus/", api_key="ExampleApiKey")
+    request_mock.assert_not_called()
+
+    assert octo.get("api/projects/ProjectName") == {"Id": "project-1"}
+    assert octo._connected
+    request_mock.assert_called_once()
+
+
+@unittest.mock.patch(
+    target="requests.Session.request", side_effect=requests.ConnectionError()
+)
+def test_init_eager_fails_without_connection(request_mock):
+    with pytest.raises(RuntimeError, match="Error connecting"):
+        OctopusClient(server="https://octopus/", max_retries=0, verify="eager")
+
+
+def test_init_unknown_verify_mode():
+    with pytest.raises(ValueError, match="verify must be one of"):
+        OctopusClient(server="https://octopus/", verify="sometimes")
+
+
+def test_session_pool_size():
+    octo = OctopusClient(server="https://octopus/", pool_size=4)
+    adapter = octo._session.get_adapter("https://octopus/")
+    assert adapter._pool_maxsize == 4
+
+
+@unittest.mock.patch("velo_action.octopus.client.time.sleep")
+@unittest.mock.patch(
+    target="requests.Session.request", side_effect=requests.ConnectTimeout()
+)
+def test_request_timeout(request_mock, sleep_mock, octo):
+    octo.baseurl = "https://octopus/"
+    with pytest.raises(RuntimeError, match="timed out"):
+        octo.get("api")
+
+
 @mock_client_requests(
     [
         Request("get", "some/path", response={"Text": "Yohoo"}),
@@ -101,8 +141,14 @@ def test_lookup_unknown_project_id(octo):
     [
         Request(
             "get",
-            "api/tenants/all",
-            response=[{"Name": "TenantName", "Id": "tenant-1"}],
+            "api/tenants?partialName=TenantName&skip=0&take=100",
+            response={
+                "TotalResults": 2,
+                "Items": [
+                    {"Name": "TenantName2", "Id": "tenant-2"},
+                    {"Name": "TenantName", "Id": "tenant-1"},
+                ],
+            },
         ),
     ]
 )
@@ -116,8 +162,8 @@ def test_lookup_tenant_id(octo):
     [
         Request(
             "get",
-            "api/tenants/all",
-            response=[{"Name": "TenantName", "Id": "tenant-1"}],
+            "api/tenants?partialName=UnknownTenant&skip=0&take=100",
+            response={"TotalResults": 0, "Items": []},
         ),
     ]
 )
@@ -126,6 +172,214 @@ def test_lookup_unknown_tenant_id(octo):
         octo.lookup_tenant_id("UnknownTenant")
 
 
+@mock_client_requests(
+    [
+        Request(
+            "get",
+            "api/tenants?partialName=Tenant&skip=0&take=100",
+            response={
+                "TotalResults": 101,
+                "Items": [
+                    {"Name": f"Tenant{i}", "Id": f"tenant-{i}"} for i in range(100)
+                ],
+            },
+        ),
+        Request(
+            "get",
+            "api/tenants?partialName=Tenant&skip=100&take=100",
+            response={
+                "TotalResults": 101,
+                "Items": [{"Name": "Tenant", "Id": "tenant"}],
+            },
+        ),
+    ]
+)
+def test_lookup_tenant_id_on_later_page(octo):
+    assert octo.lookup_tenant_id("Tenant") == "tenant"
+
+
+@mock_client_requests(
+    [
+        Request(
+            "get",
+            "api/tenants/all",
+            response=[
+                {"Name": "TenantA", "Id": "tenant-a"},
+                {"Name": "TenantB", "Id": "tenant-b"},
+            ],
+        ),
+    ]
+)
+def test_warm_up_tenants(octo):
+    octo.warm_up_tenants(["TenantA"])
+    assert octo.lookup_tenant_id("TenantA") == "tenant-a"
+    assert octo._lookups.stats().size == 1
+
+
+@mock_client_requests(
+    [
+        Request(
+            "get",
+            "api/tenants?tags=region%2Feu&tags=tier%2Fcanary&skip=0&take=100",
+            response={
+                "TotalResults": 2,
+                "Items": [
+                    {"Name": "TenantA", "Id": "tenant-a"},
+                    {"Name": "TenantB", "Id": "tenant-b"},
+                ],
+            },
+        ),
+    ]
+)
+def test_lookup_tenants_by_tags(octo):
+    assert octo.lookup_tenants_by_tags(["tier/canary", "region/eu"]) == (
+        "TenantA",
+        "TenantB",
+    )
+    # Repeated selections and the tenant ids are served from the index
+    assert octo.lookup_tenants_by_tags(["region/eu", "tier/canary"]) == (
+        "TenantA",
+        "TenantB",
+    )
+    assert octo.lookup_tenant_id("TenantB") == "tenant-b"
+    assert octo.uncached_tenants(["TenantA", "TenantC", ""]) == ["TenantC"]
+
+
 def test_lookup_tenant_id_without_name(octo):
     assert octo.lookup_tenant_id(None) == ""
     assert octo.lookup_tenant_id("") == ""
+
+
+def response_mock(status_code, json=None, headers=None):
+    response = unittest.mock.Mock(
+        status_code=status_code,
+        content=b"{}" if json is not None else b"",
+        headers=headers or {},
+        reason="Reason",
+    )
+    response.json.return_value = json
+    return response
+
+
+@unittest.mock.patch("velo_action.octopus.client.time.sleep")
+@unittest.mock.patch(target="requests.Session.request")
+def test_get_retries_transient_errors(request_mock, sleep_mock, octo):
+    request_mock.side_effect = [
+        response_mock(503),
+        response_mock(429, headers={"Retry-After": "2"}),
+        requests.ConnectionError(),
+        response_mock(200, json={"Id": "project-1"}),
+    ]
+
+    assert octo.get("api/projects/ProjectName") == {"Id": "project-1"}
+    assert request_mock.call_count == 4
+    assert sleep_mock.call_count == 3
+    assert sleep_mock.call_args_list[1].args == (2.0,)
+
+
+@unittest.mock.patch("velo_action.octopus.client.time.sleep")
+@unittest.mock.patch(target="requests.Session.request")
+def test_get_gives_up_after_max_retries(request_mock, sleep_mock, octo):
+    octo.max_retries = 2
+    request_mock.return_value = response_mock(502, json={"ErrorMessage": "Bad gateway"})
+
+    with pytest.raises(RuntimeError, match="Bad gateway"):
+        octo.get("api/projects/ProjectName")
+    assert request_mock.call_count == 3
+
+
+@unittest.mock.patch("velo_action.octopus.client.time.sleep")
+@unittest.mock.patch(target="requests.Session.request")
+def test_post_retried_when_not_created(request_mock, sleep_mock, octo):
+    request_mock.side_effect = [
+        response_mock(503),
+        response_mock(404, json={"ErrorMessage": "Not found"}),
+        response_mock(201, json={"Id": "release-1"}),
+    ]
+
+    release = octo.post(
+        "api/releases", data={"ProjectId": "project-1", "Version": "v1"}
+    )
+
+    assert release == {"Id": "release-1"}
+    assert request_mock.call_args_list[1].args[:2] == (
+        "get",
+        "api/projects/project-1/releases/v1",
+    )
+
+
+@pytest.mark.parametrize(
+    "created",
+    [
+        datetime.now(timezone.utc).isoformat(),
+        # Without an offset the timestamp is taken as UTC
+        datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),
+    ],
+)
+@unittest.mock.patch("velo_action.octopus.client.time.sleep")
+@unittest.mock.patch(target="requests.Session.request")
+def test_post_not_retried_when_created(request_mock, sleep_mock, octo, created):
+    request_mock.side_effect = [
+        response_mock(502),
+        response_mock(
+            200,
+            json={
+                "Items": [
+                    {
+                        "Id": "deployment-1",
+                        "EnvironmentId": "env-1",
+                        "TenantId": None,
+                        "Created": created,
+                    }
+                ]
+            },
+        ),
+    ]
+
+    deployment = octo.post(
+        "api/deployments", data={"ReleaseId": "release-1", "EnvironmentId": "env-1"}
+    )
+
+    assert deployment["Id"] == "deployment-1"
+    assert request_mock.call_count == 2
+    sleep_mock.assert_not_called()
+
+
+@unittest.mock.patch(target="requests.Session.request")
+def test_post_to_other_paths_not_retried(request_mock, octo):
+    request_mock.return_value = response_mock(503, json={"ErrorMessage": "Down"})
+
+    with pytest.raises(RuntimeError, match="Down"):
+        octo.post("api/tasks", data={})
+    request_mock.assert_called_once()
+
+
+@unittest.mock.patch(target="requests.Session.request")
+def test_get_text_uses_range(request_mock, octo):
+    request_mock.return_value = unittest.mock.Mock(status_code=206, content=b"new\n")
+
+    assert octo.get_text("api/tasks/ServerTasks-1/raw", offset=10) == "new\n"
+    assert request_mock.call_args.kwargs["headers"]["Range"] == "bytes=10-"
+
+
+@unittest.mock.patch(target="requests.Session.request")
+def test_get_text_without_range_support(request_mock, octo):
+    request_mock.return_value = unittest.mock.Mock(
+        status_code=200, content=b"seen\nnew\n"
+    )
+
+    assert octo.get_text("api/tasks/ServerTasks-1/raw", offset=5) == "new\n"
+
+
+@unittest.mock.patch(target="requests.Session.request")
+def test_authorization_header_per_request(request_mock):
+    request_mock.return_value = response_mock(200, json={})
+    octo = OctopusClient(server="https://octopus/", api_key="ExampleApiKey")
+    octo._tokens = unittest.mock.Mock(**{"token.side_effect": ["t1", "t2"]})
+
+    octo.get("api/a")
+    octo.get("api/b")
+
+    headers = [call.kwargs["headers"] for call in request_mock.call_args_list]
+    assert [h["Authorization"] for h in headers] == ["Bearer t1", "Bearer t2"]
+    octo._tokens.token.assert_called_with("https://octopus/")
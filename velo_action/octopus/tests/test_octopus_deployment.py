@@ -1,3 +1,5 @@
+# pylint: disable=protected-access
+from datetime import timedelta
 from unittest.mock import Mock
 
 import pytest
@@ -7,11 +9,6 @@ from velo_action.octopus.tests.test_decorators import Request, mock_client_reque
 
 
 @pytest.fixture
-@mock_client_requests(
-    [
-        Request("head", "api", response=True),
-    ]
-)
 def octo() -> client.OctopusClient:
     return client.OctopusClient()
 
@@ -254,3 +251,339 @@ def test_create_with_wait(monkeypatch, deployment1):
         client.OctopusClient, "lookup_environment_id", Mock(return_value="env-1")
     )
     deployment1.create("dev-env", wait_seconds=0.1)
+
+
+@mock_client_requests(
+    [
+        Request(
+            "get",
+            f"api/releases/release-1/deployments/preview/{env_id}",
+            response={
+                "Form": {
+                    "Elements": [{"Name": f"{env_id}-var", "Control": {"Name": "VAR"}}]
+                }
+            },
+        )
+        for env_id in ("env-1", "env-2")
+    ]
+)
+def test_prefetch_variable_mappings(monkeypatch, release1, octo):
+    monkeypatch.setattr(
+        client.OctopusClient,
+        "lookup_environment_id",
+        Mock(side_effect={"staging": "env-1", "prod": "env-2"}.get),
+    )
+    deployment.prefetch_variable_mappings(release1, octo, ["staging", "prod"])
+
+    # Served from the client without another request
+    for _ in range(2):
+        assert deployment.variable_name_to_id_mapping(octo, "release-1", "env-2") == {
+            "VAR": "env-2-var"
+        }
+
+
+def test_fan_out_deployments(monkeypatch, release1, octo):
+    monkeypatch.setattr(
+        client.OctopusClient, "lookup_environment_id", Mock(return_value="env-1")
+    )
+    monkeypatch.setattr(
+        client.OctopusClient, "lookup_tenant_id", Mock(return_value="tenant-1")
+    )
+    create = Mock()
+    monkeypatch.setattr(deployment.Deployment, "create", create)
+    monkeypatch.setattr(
+        deployment.DeploymentWaiter,
+        "wait",
+        lambda _self, deps, **_: {d: deployment.DeploymentState.SUCCESS for d in deps},
+    )
+
+    outcomes = deployment.fan_out_deployments(
+        release=release1,
+        client=octo,
+        environments=["staging", "prod"],
+        tenants=["fc:osl1", "fc:rd1"],
+        wait_seconds=10,
+        max_parallel=2,
+    )
+
+    assert outcomes == [
+        ("staging", "fc:osl1", deployment.DeploymentState.SUCCESS, ""),
+        ("staging", "fc:rd1", deployment.DeploymentState.SUCCESS, ""),
+        ("prod", "fc:osl1", deployment.DeploymentState.SUCCESS, ""),
+        ("prod", "fc:rd1", deployment.DeploymentState.SUCCESS, ""),
+    ]
+    assert create.call_count == 4
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_fan_out_deployments_warms_up_uncached_tenants(
+    monkeypatch, release1, octo, cached
+):
+    tenants = [f"tenant-{i}" for i in range(deployment.TENANT_WARM_UP_THRESHOLD)]
+    if cached:
+        for ten in tenants:
+            octo._lookups.put(f"tenant:{ten}", ten)
+    monkeypatch.setattr(
+        client.OctopusClient, "lookup_environment_id", Mock(return_value="env-1")
+    )
+    warm_up = Mock(
+        side_effect=lambda names: [octo._lookups.put(f"tenant:{n}", n) for n in names]
+    )
+    monkeypatch.setattr(client.OctopusClient, "warm_up_tenants", warm_up)
+    monkeypatch.setattr(deployment.Deployment, "create", Mock())
+
+    deployment.fan_out_deployments(
+        release=release1, client=octo, environments=["staging"], tenants=tenants
+    )
+
+    if cached:
+        warm_up.assert_not_called()
+    else:
+        warm_up.assert_called_once_with(tenants)
+
+
+def test_fan_out_deployments_stops_promotion_on_failure(monkeypatch, release1, octo):
+    monkeypatch.setattr(
+        client.OctopusClient, "lookup_environment_id", Mock(return_value="env-1")
+    )
+    monkeypatch.setattr(
+        client.OctopusClient, "lookup_tenant_id", Mock(return_value="tenant-1")
+    )
+
+    def create(_self, env_name, tenant, **_):
+        if tenant == "fc:rd1":
+            raise RuntimeError("Tenant is not connected")
+
+    monkeypatch.setattr(deployment.Deployment, "create", create)
+
+    outcomes = deployment.fan_out_deployments(
+        release=release1,
+        client=octo,
+        environments=["staging", "prod"],
+        tenants=["fc:osl1", "fc:rd1"],
+    )
+
+    assert [o.state for o in outcomes] == [
+        deployment.DeploymentState.CREATED,
+        deployment.DeploymentState.FAIL,
+        deployment.DeploymentState.SKIPPED,
+        deployment.DeploymentState.SKIPPED,
+    ]
+    assert outcomes[1].error == "Tenant is not connected"
+
+
+@pytest.mark.parametrize("max_parallel", [1, 2])
+def test_fan_out_deployments_bounds_running_deployments(
+    monkeypatch, release1, octo, max_parallel
+):
+    monkeypatch.setattr(
+        client.OctopusClient, "lookup_environment_id", Mock(return_value="env-1")
+    )
+    monkeypatch.setattr(
+        client.OctopusClient, "lookup_tenant_id", Mock(return_value="tenant-1")
+    )
+    running = set()
+    most_running = []
+
+    def create(self, env_name, tenant, **_):
+        self._label = tenant
+        running.add(self)
+        most_running.append(len(running))
+
+    def wait(_self, deps, **_):
+        # Complete one deployment per call, the second tenant fails
+        dep = deps[0]
+        running.remove(dep)
+        if dep.label() == "b":
+            return {dep: deployment.DeploymentState.FAIL}
+        return {dep: deployment.DeploymentState.SUCCESS}
+
+    monkeypatch.setattr(deployment.Deployment, "create", create)
+    monkeypatch.setattr(deployment.DeploymentWaiter, "wait", wait)
+
+    outcomes = deployment.fan_out_deployments(
+        release=release1,
+        client=octo,
+        environments=["staging"],
+        tenants=["a", "b", "c", "d"],
+        wait_seconds=10,
+        max_parallel=max_parallel,
+    )
+
+    assert max(most_running) == max_parallel
+    states = [o.state for o in outcomes]
+    if max_parallel == 1:
+        assert states == [
+            deployment.DeploymentState.SUCCESS,
+            deployment.DeploymentState.FAIL,
+            deployment.DeploymentState.SKIPPED,
+            deployment.DeploymentState.SKIPPED,
+        ]
+    else:
+        # 'c' starts when 'a' completes, nothing starts after 'b' failed
+        assert states == [
+            deployment.DeploymentState.SUCCESS,
+            deployment.DeploymentState.FAIL,
+            deployment.DeploymentState.SUCCESS,
+            deployment.DeploymentState.SKIPPED,
+        ]
+
+
+@mock_client_requests(
+    [
+        Request(
+            "get",
+            "api/tasks?ids=task-1,task-2&take=2",
+            response={
+                "Items": [
+                    {"Id": "task-1", "State": "Executing"},
+                    {"Id": "task-2", "State": "Success"},
+                ]
+            },
+        ),
+        Request(
+            "get",
+            "api/tasks?ids=task-1&take=1",
+            response={"Items": [{"Id": "task-1", "State": "Failed"}]},
+        ),
+    ]
+)
+def test_waiter_polls_all_tasks_in_one_request(monkeypatch, release1, octo):
+    monkeypatch.setattr(deployment, "sleep", Mock())
+    first = deployment.Deployment.from_release(release1, client=octo)
+    first._octo_object = {"Id": "deployment-1", "TaskId": "task-1"}
+    second = deployment.Deployment.from_release(release1, client=octo)
+    second._octo_object = {"Id": "deployment-2", "TaskId": "task-2"}
+
+    states = deployment.DeploymentWaiter(octo).wait(
+        [first, second], timedelta(seconds=10)
+    )
+
+    assert states == {
+        first: deployment.DeploymentState.FAIL,
+        second: deployment.DeploymentState.SUCCESS,
+    }
+    assert first.state() == deployment.DeploymentState.FAIL
+    assert second.state() == deployment.DeploymentState.SUCCESS
+
+
+def test_polling_policy_backs_off_to_maximum():
+    policy = deployment.PollingPolicy(initial=1, maximum=10, factor=2, jitter=0)
+    assert [policy.interval(tick, elapsed=0) for tick in range(6)] == [
+        1,
+        2,
+        4,
+        8,
+        10,
+        10,
+    ]
+
+
+def test_polling_policy_long_waits():
+    assert deployment.PollingPolicy(initial=1, jitter=0).interval(100_000, 0) == 30
+    fixed = deployment.PollingPolicy(initial=1, maximum=1, jitter=0)
+    assert fixed.interval(100_000, elapsed=0) == 1
+
+
+def test_polling_policy_shortens_near_expected_duration():
+    policy = deployment.PollingPolicy(initial=1, maximum=30, jitter=0)
+    assert policy.interval(10, elapsed=100, expected=600) == 30
+    assert policy.interval(10, elapsed=590, expected=600) == 5
+    assert policy.interval(10, elapsed=599, expected=600) == 1
+
+
+def test_polling_policy_jitter():
+    policy = deployment.PollingPolicy(initial=10, jitter=0.1)
+    assert all(9 <= policy.interval(0, elapsed=0) <= 11 for _ in range(20))
+
+
+def test_waiter_requires_duration_or_deadlines(octo):
+    with pytest.raises(ValueError, match="'duration' or 'deadlines'"):
+        deployment.DeploymentWaiter(octo).wait([])
+
+
+@mock_client_requests(
+    [
+        Request(
+            "get",
+            "api/tasks?project=project-1&environment=env-1&name=Deploy&states=Success&take=1",
+            response={
+                "Items": [
+                    {
+                        "StartTime": "2022-08-04T08:00:00.000+00:00",
+                        "CompletedTime": "2022-08-04T08:05:00.000+00:00",
+                    }
+                ]
+            },
+        ),
+    ]
+)
+def test_waiter_expected_duration(release1, octo):
+    dep = deployment.Deployment.from_release(release1, client=octo)
+    dep._environment_id = "env-1"
+    waiter = deployment.DeploymentWaiter(octo)
+
+    assert waiter._expected_duration(dep) == 300
+    # Cached per project and environment
+    assert waiter._expected_duration(dep) == 300
+
+
+@mock_client_requests(
+    [
+        Request("get", "api/tasks/ServerTasks-1", response={"State": "Executing"}),
+        Request("get", "api/tasks/ServerTasks-1", response={"State": "Success"}),
+    ]
+)
+def test_get_state_from_task(deployment1):
+    deployment1._octo_object = {"Id": "deployment-1", "TaskId": "ServerTasks-1"}
+    assert deployment1.get_state() == deployment.DeploymentState.PROGRESS
+    assert deployment1.get_state() == deployment.DeploymentState.SUCCESS
+
+
+@mock_client_requests(
+    [
+        Request(
+            "get",
+            "api/projects/project-1/progression",
+            response={
+                "Releases": [
+                    {"Release": {"Id": "release-1"}, "Deployments": {"env-1": []}}
+                ]
+            },
+        ),
+    ]
+)
+def test_get_state_not_yet_in_progression(deployment1):
+    deployment1._octo_object = {"Id": "deployment-1"}
+    assert (
+        deployment1.get_state(environment_id="env-1", tenant_id="")
+        == deployment.DeploymentState.PROGRESS
+    )
+
+
+def test_task_log_tail_only_prints_new_lines(monkeypatch, octo):
+    log = "Step 1\nStep 2\nStep"
+    offsets = []
+
+    def get_text(_self, path, offset=0):
+        assert path == "api/tasks/ServerTasks-1/raw"
+        offsets.append(offset)
+        return log[offset:]
+
+    monkeypatch.setattr(client.OctopusClient, "get_text", get_text)
+    info = Mock()
+    monkeypatch.setattr(deployment.logger, "info", info)
+
+    tail = deployment.TaskLogTail(octo, "ServerTasks-1", prefix="[prod/fc:osl1] ")
+    tail.poll()
+    log += " 3\nDone"
+    tail.poll()
+    tail.poll(final=True)
+
+    assert offsets == [0, 14, 21]
+    assert [call.args[0] for call in info.call_args_list] == [
+        "[prod/fc:osl1] Step 1",
+        "[prod/fc:osl1] Step 2",
+        "[prod/fc:osl1] Step 3",
+        "[prod/fc:osl1] Done",
+    ]
@@ -7,6 +7,7 @@ from velo_action.octopus.release import (
     VELO_BOOTSTRAPPER_ACTION_NAME,
     VELO_BOOTSTRAPPER_PACKAGE_ID,
     Release,
+    create_release_notes,
 )
 from velo_action.octopus.tests.test_decorators import Request, mock_client_requests
 from velo_action.settings import VELO_TRACE_ID_NAME
@@ -15,7 +16,6 @@ from velo_action.settings import VELO_TRACE_ID_NAME
 @pytest.fixture
 @mock_client_requests(
     [
-        Request("head", "api", response=True),
         Request("get", "api/projects/ProjectName", response={"Id": "project-1"}),
         Request(
             "get",
@@ -40,11 +40,6 @@ def prepared_release():
 
 
 @pytest.fixture
-@mock_client_requests(
-    [
-        Request("head", "api", response=True),
-    ]
-)
 def client():
     return OctopusClient()
 
@@ -118,6 +113,68 @@ def test_determine_latest_deploy_packages(prepared_release):
     ) == [{"ActionName": "FirstAction", "Version": "0.1.9"}]
 
 
+@mock_client_requests(
+    [
+        Request(
+            "get",
+            "api/projects/project-1/deploymentprocesses/template",
+            response={
+                "Packages": [
+                    {"FeedId": "feed-1", "PackageId": "package-1", "ActionName": "A"},
+                    {"FeedId": "feed-1", "PackageId": "package-2", "ActionName": "B"},
+                    {"FeedId": "feed-1", "PackageId": "package-1", "ActionName": "C"},
+                ]
+            },
+        ),
+        Request(
+            "get",
+            r"api/feeds/feed-1/packages/versions?packageId=package-1&preReleaseTag=^(|\+.*)$&take=1",
+            response={"Items": [{"Version": "0.1.9"}]},
+        ),
+        Request(
+            "get",
+            r"api/feeds/feed-1/packages/versions?packageId=package-2&preReleaseTag=^(|\+.*)$&take=1",
+            response={"Items": [{"Version": "2.0.0"}]},
+        ),
+    ]
+)
+def test_determine_latest_deploy_packages_once_per_package(prepared_release):
+    assert prepared_release._determine_latest_deploy_packages(
+        prepared_release.project_id()
+    ) == [
+        {"ActionName": "A", "Version": "0.1.9"},
+        {"ActionName": "B", "Version": "2.0.0"},
+        {"ActionName": "C", "Version": "0.1.9"},
+    ]
+
+
+@mock_client_requests(
+    [
+        Request("get", "api/projects/ProjectName", response={"Id": "project-1"}),
+        Request(
+            "post",
+            "api/releases",
+            payload={
+                "ProjectId": "project-1",
+                "Version": "v2",
+                "ReleaseNotes": "notes",
+            },
+            response={"Id": "release-2", "ProjectId": "project-1", "Version": "v2"},
+        ),
+    ]
+)
+def test_prepare_and_submit(client, default_github_settings):
+    rel = Release(client)
+    payload = rel.prepare(
+        "ProjectName", "v2", default_github_settings, auto_select_packages=False
+    )
+    assert payload["ProjectId"] == "project-1"
+    assert payload["ReleaseNotes"] == create_release_notes(default_github_settings)
+
+    rel.submit({**payload, "ReleaseNotes": "notes"})
+    assert rel.id() == "release-2"
+
+
 @mock_client_requests(
     [
         Request("get", "api/projects/ProjectName", response={"Id": "project-1"}),
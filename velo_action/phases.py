@@ -0,0 +1,102 @@
+import typing
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+
+from loguru import logger
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class Phase(typing.NamedTuple):
+    name: str
+    func: typing.Callable
+    requires: typing.Tuple[str, ...] = ()
+
+
+class PhaseTiming(typing.NamedTuple):
+    name: str
+    started: datetime
+    finished: datetime
+
+    @property
+    def seconds(self) -> float:
+        return (self.finished - self.started).total_seconds()
+
+
+class PhaseGraph:
+    """
+    Runs the phases of the action as a dependency graph
+
+    A phase starts on the thread pool as soon as the phases it requires are
+    done, and is called with their results as positional arguments. Phases can
+    only require phases added before them, so the graph has no cycles.
+
+    The first failing phase cancels the phases that have not started yet. Its
+    error is raised once the running phases are done.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS):
+        self.max_workers = max_workers
+        self.phases: typing.Dict[str, Phase] = {}
+        self.timings: typing.Dict[str, PhaseTiming] = {}
+
+    def add(self, name, func, requires=()):
+        if name in self.phases:
+            raise ValueError(f"Phase '{name}' is already added")
+        unknown = [req for req in requires if req not in self.phases]
+        if unknown:
+            raise ValueError(f"Phase '{name}' requires unknown phases {unknown}")
+        self.phases[name] = Phase(name, func, tuple(requires))
+
+    def run(self) -> dict:
+        """Run all phases, returns the result of each phase by name"""
+        results: dict = {}
+        pending = dict(self.phases)
+        running: dict = {}
+        error = None
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                ready = [
+                    phase
+                    for phase in pending.values()
+                    if all(req in results for req in phase.requires)
+                ]
+                for phase in ready if error is None else []:
+                    del pending[phase.name]
+                    args = [results[req] for req in phase.requires]
+                    running[executor.submit(self._run_phase, phase, args)] = phase
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    phase = running.pop(future)
+                    try:
+                        results[phase.name] = future.result()
+                    except BaseException as err:  # pylint: disable=broad-except
+                        logger.debug(f"Phase '{phase.name}' failed: {err}")
+                        error = error or err
+
+        self._log_timings()
+        if error is not None:
+            if pending:
+                logger.info(f"Cancelled phases: {', '.join(pending)}")
+            raise error
+        return results
+
+    def _run_phase(self, phase, args):
+        started = datetime.now(timezone.utc)
+        try:
+            return phase.func(*args)
+        finally:
+            self.timings[phase.name] = PhaseTiming(
+                phase.name, started, datetime.now(timezone.utc)
+            )
+
+    def _log_timings(self):
+        for timing in sorted(self.timings.values(), key=lambda t: t.started):
+            logger.info(
+                f"Phase '{timing.name}' ran from {timing.started:%H:%M:%S.%f} "
+                f"to {timing.finished:%H:%M:%S.%f} ({timing.seconds:.1f} seconds)"
+            )
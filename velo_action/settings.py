@@ -111,10 +111,40 @@ class ActionInputs(BaseSettings):
     tenants: Union[
         str, List[str]
     ] = []  # see https://github.com/samuelcolvin/pydantic/issues/1458
+    tenant_tags: Union[
+        str, List[str]
+    ] = []  # see https://github.com/samuelcolvin/pydantic/issues/1458
 
     velo_artifact_bucket_secret: Optional[str] = "velo_action_artifacts_bucket_name"
+    # Use the highest enabled secret version instead of the 'latest' alias
+    secret_enabled_versions_only: bool = False
+
+    # Number of files uploaded to the artifact bucket in parallel
+    upload_concurrency: int = 16
+    # Skip files already present in the artifact bucket with the same checksum
+    incremental_upload: bool = False
+    # Copy unchanged files server-side from the previously uploaded version
+    reuse_previous_artifacts: bool = False
+    # Upload files larger than this in parallel chunks. 0 disables it.
+    composite_upload_threshold_mb: int = 0
+    # Upload the deploy folder as one compressed archive, either 'gzip' or 'zstd'
+    artifact_archive: Optional[str] = None
 
     wait_for_success_seconds: int = 0
+    # Number of tenants deployed to at the same time within one environment
+    max_parallel_deployments: int = 1
+    # Interval between checks of the deployment state, growing from initial to max
+    poll_interval_seconds: float = 1
+    poll_interval_max_seconds: float = 30
+    # Print the Octopus task log while waiting for deployments
+    stream_deployment_logs: bool = False
+    # Seconds to wait for a response from Octopus Deploy
+    octopus_request_timeout_seconds: int = 60
+    # Total seconds spent retrying transient Octopus Deploy errors per request
+    octopus_retry_budget_seconds: int = 60
+    octopus_metadata_cache_ttl_seconds: int = 3600
+    # When to check the connection to Octopus Deploy: eager, lazy or off
+    octopus_verify_connection: str = "lazy"
     wait_for_deployment: bool = False
 
     # Variables making debugging easier
@@ -139,7 +169,7 @@ class ActionInputs(BaseSettings):
             return generate_version()
         return value
 
-    @validator("deploy_to_environments", "tenants", pre=True)
+    @validator("deploy_to_environments", "tenants", "tenant_tags", pre=True)
     def split_list(cls, value):
         if value in ("None", ""):
             return []
@@ -158,6 +188,7 @@ class ActionInputs(BaseSettings):
         "octopus_api_key_secret",
         "velo_artifact_bucket_secret",
         "workspace",
+        "artifact_archive",
         pre=True,
     )
     def normalize_str(cls, value):
@@ -166,6 +197,41 @@ class ActionInputs(BaseSettings):
             return None
         return value
 
+    @validator("upload_concurrency", "max_parallel_deployments")
+    def validate_at_least_one(cls, value):
+        if value < 1:
+            raise ValueError("Must be at least 1.")
+        return value
+
+    @validator("artifact_archive")
+    def validate_artifact_archive(cls, value):
+        if value is not None and value not in ("gzip", "zstd"):
+            raise ValueError("Must be either 'gzip' or 'zstd'.")
+        return value
+
+    @validator("octopus_verify_connection")
+    def validate_octopus_verify_connection(cls, value):
+        if value not in ("eager", "lazy", "off"):
+            raise ValueError("Must be one of 'eager', 'lazy' or 'off'.")
+        return value
+
+    @validator("poll_interval_seconds")
+    def validate_positive(cls, value):
+        if value <= 0:
+            raise ValueError("Must be greater than 0.")
+        return value
+
+    @validator("poll_interval_max_seconds")
+    def validate_poll_interval(cls, value, values):
+        if (
+            "poll_interval_seconds" in values
+            and value < values["poll_interval_seconds"]
+        ):
+            raise ValueError(
+                "Must be greater than or equal to 'poll_interval_seconds'."
+            )
+        return value
+
     @validator("log_level")
     def validate_log_level(cls, value):
         name = logger.level(value)
@@ -24,6 +24,7 @@ def test_github_default_values(generate_version, monkeypatch):
     assert sett.service_account_key is None
     assert isinstance(sett.tenants, list) and len(sett.tenants) == 0
     assert sett.velo_artifact_bucket_secret == "velo_action_artifacts_bucket_name"
+    assert sett.upload_concurrency == 16
     assert sett.version == generate_version.return_value
     assert sett.wait_for_deployment is False
     assert sett.workspace is None
@@ -114,6 +115,13 @@ def test_parse_2item_list(monkeypatch):
     assert sett.deploy_to_environments == ["Some", "More"]
 
 
+def test_parse_tenant_tags(monkeypatch):
+    fill_default_action_envvars(monkeypatch)
+    monkeypatch.setenv("INPUT_TENANT_TAGS", "region/eu,tier/canary")
+    sett = ActionInputs()
+    assert sett.tenant_tags == ["region/eu", "tier/canary"]
+
+
 def test_fail_on_unknown_log_level():
     with pytest.raises(ValidationError):
         ActionInputs(log_level="INVALID_LOG_LEVEL")
@@ -171,3 +179,17 @@ def test_wait_for_deployment_becomes_wait_for_success_seconds(
     )
     assert both.wait_for_deployment is False
     assert both.wait_for_success_seconds == 120
+
+
+def test_fail_on_unknown_octopus_verify_connection(monkeypatch):
+    fill_default_action_envvars(monkeypatch)
+    monkeypatch.setenv("INPUT_OCTOPUS_VERIFY_CONNECTION", "sometimes")
+    with pytest.raises(ValidationError):
+        ActionInputs()
+
+
+def test_fail_on_zero_poll_interval(monkeypatch):
+    fill_default_action_envvars(monkeypatch)
+    monkeypatch.setenv("INPUT_POLL_INTERVAL_SECONDS", "0")
+    with pytest.raises(ValidationError):
+        ActionInputs()
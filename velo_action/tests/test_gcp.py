@@ -1,8 +1,27 @@
+# pylint: disable=redefined-outer-name,too-few-public-methods
+import base64
+import io
+import itertools
+import json
 import os
+import tarfile
+import threading
+import time
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
 
+import google_crc32c  # type: ignore
 import pytest
+import requests
+import zstandard
+from google.api_core.exceptions import FailedPrecondition
+from google.auth.credentials import AnonymousCredentials
+from google.cloud import storage  # type: ignore
 
-from velo_action.gcp import GCP
+from velo_action.gcp import LATEST_SECRET_VERSION, GCP, local_crc32c
+from velo_action.utils import iter_deploy_files
 
 
 def has_encoded_key():
@@ -30,3 +49,385 @@ def test_gcp_un_encoded():
 
     service_account_json = service_account_json.replace(os.linesep, "")
     GCP(service_account_json)
+
+
+@pytest.fixture
+def deploy_folder():
+    with TemporaryDirectory() as tempdir:
+        path = Path(tempdir)
+        (path / "app.yml").write_text("project: test\n", encoding="utf-8")
+        (path / "k8s").mkdir()
+        (path / "k8s" / "deployment.yml").write_text(
+            "kind: Deployment\n", encoding="utf-8"
+        )
+        yield path
+
+
+@pytest.fixture
+def storage_bucket():
+    bucket = MagicMock()
+    with patch.object(GCP, "_get_storage_client") as get_client:
+        get_client.return_value.get_bucket.return_value = bucket
+        yield bucket
+
+
+def test_upload_from_directory(deploy_folder, storage_bucket):
+    files = GCP("project").upload_from_directory(
+        path=deploy_folder,
+        dest_bucket_name="bucket",
+        dest_blob_name="project/v1",
+        concurrency=2,
+    )
+
+    assert sorted(files) == ["app.yml", "k8s/deployment.yml"]
+    storage_bucket.blob.assert_any_call("project/v1/app.yml")
+    storage_bucket.blob.assert_any_call("project/v1/k8s/deployment.yml")
+
+
+def test_upload_from_directory_reports_all_failures(deploy_folder, storage_bucket):
+    storage_bucket.blob.return_value.upload_from_filename.side_effect = OSError(
+        "connection reset"
+    )
+
+    with pytest.raises(RuntimeError, match="Failed to upload 2 of 2 files") as err:
+        GCP("project").upload_from_directory(
+            path=deploy_folder, dest_bucket_name="bucket", dest_blob_name="project/v1"
+        )
+    assert "app.yml: connection reset" in str(err.value)
+    assert "k8s/deployment.yml: connection reset" in str(err.value)
+
+
+def test_upload_from_directory_incremental(deploy_folder, storage_bucket):
+    unchanged = MagicMock(
+        size=len("project: test\n"), crc32c=local_crc32c(deploy_folder / "app.yml")
+    )
+    unchanged.name = "project/v1/app.yml"
+    changed = MagicMock(size=1, crc32c="AAAAAA==")
+    changed.name = "project/v1/k8s/deployment.yml"
+
+    with patch.object(GCP, "_get_storage_client") as get_client:
+        get_client.return_value.get_bucket.return_value = storage_bucket
+        get_client.return_value.list_blobs.return_value = [unchanged, changed]
+        files = GCP("project").upload_from_directory(
+            path=deploy_folder,
+            dest_bucket_name="bucket",
+            dest_blob_name="project/v1",
+            incremental=True,
+        )
+
+    assert sorted(files) == ["app.yml", "k8s/deployment.yml"]
+    storage_bucket.blob.assert_called_once_with("project/v1/k8s/deployment.yml")
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+def test_upload_archive_from_directory(compression, deploy_folder, storage_bucket):
+    uploaded = {}
+
+    def upload_from_file(stream, **_):
+        uploaded["archive"] = stream.read()
+
+    storage_bucket.blob.return_value.upload_from_file.side_effect = upload_from_file
+    storage_bucket.blob.return_value.upload_from_string.side_effect = (
+        lambda data, **_: uploaded.update(manifest=data)
+    )
+
+    archive = GCP("project").upload_archive_from_directory(
+        path=deploy_folder,
+        dest_bucket_name="bucket",
+        dest_blob_name="project/v1",
+        compression=compression,
+    )
+
+    data = uploaded["archive"]
+    if compression == "zstd":
+        data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)).read()
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert sorted(tar.getnames()) == ["app.yml", "k8s/deployment.yml"]
+
+    assert sorted(archive.members) == ["app.yml", "k8s/deployment.yml"]
+    assert archive.size == len(uploaded["archive"])
+    assert archive.uncompressed_size == 31
+    manifest = json.loads(uploaded["manifest"])
+    assert manifest["archive"] == archive.name
+    assert {m["path"] for m in manifest["members"]} == set(archive.members)
+    storage_bucket.blob.assert_any_call(f"project/v1/{archive.name}.manifest.json")
+
+
+def test_upload_archive_is_not_finalized_when_writing_fails(
+    deploy_folder, storage_bucket
+):
+    finalized = []
+
+    def upload_from_file(stream, **_):
+        while len(stream.read(8192)) == 8192:
+            pass
+        finalized.append(stream.tell())
+
+    def failing_files(path):
+        yield from itertools.islice(iter_deploy_files(path), 1)
+        raise OSError("Disk read error")
+
+    storage_bucket.blob.return_value.upload_from_file.side_effect = upload_from_file
+
+    with patch("velo_action.gcp.iter_deploy_files", failing_files):
+        with pytest.raises(RuntimeError, match="Failed to create 'deploy.tar.gz'"):
+            GCP("project").upload_archive_from_directory(
+                path=deploy_folder,
+                dest_bucket_name="bucket",
+                dest_blob_name="project/v1",
+            )
+
+    assert not finalized
+    storage_bucket.blob.return_value.upload_from_string.assert_not_called()
+
+
+def test_upload_from_directory_reuses_previous_version(deploy_folder, storage_bucket):
+    previous = MagicMock(
+        size=len("project: test\n"),
+        crc32c=local_crc32c(deploy_folder / "app.yml"),
+        updated=2,
+    )
+    previous.name = "project/v1/app.yml"
+    storage_bucket.blob.return_value.rewrite.return_value = (None, 14, 14)
+    listed = []
+
+    def list_blobs(_bucket, prefix, delimiter=None, max_results=None, **_):
+        listed.append(prefix)
+        if delimiter:
+            listing = MagicMock(prefixes={"project/v0/", "project/v1/", "project/v2/"})
+            listing.__iter__.return_value = iter([])
+            return listing
+        if max_results:
+            return [MagicMock(updated={"project/v0/": 1, "project/v1/": 2}[prefix])]
+        return {"project/v1/": [previous]}[prefix]
+
+    with patch.object(GCP, "_get_storage_client") as get_client:
+        get_client.return_value.get_bucket.return_value = storage_bucket
+        get_client.return_value.list_blobs.side_effect = list_blobs
+        files = GCP("project").upload_from_directory(
+            path=deploy_folder,
+            dest_bucket_name="bucket",
+            dest_blob_name="project/v2",
+            reuse_previous=True,
+        )
+
+    assert sorted(files) == ["app.yml", "k8s/deployment.yml"]
+    # Only the version prefixes and the objects of the previous version are listed
+    assert sorted(listed) == ["project/", "project/v0/", "project/v1/", "project/v1/"]
+    storage_bucket.blob.return_value.rewrite.assert_called_once_with(previous)
+    storage_bucket.blob.return_value.upload_from_filename.assert_called_once()
+
+
+def test_upload_from_directory_composes_large_files(deploy_folder, storage_bucket):
+    (deploy_folder / "model.bin").write_bytes(b"0123456789" * 5)
+    parts = {}
+
+    def blob(name):
+        mock = MagicMock()
+        mock.name = name
+        mock.upload_from_file.side_effect = lambda f, size: parts.update(
+            {name: f.read(size)}
+        )
+        return mock
+
+    storage_bucket.blob.side_effect = blob
+
+    GCP("project").upload_from_directory(
+        path=deploy_folder,
+        dest_bucket_name="bucket",
+        dest_blob_name="project/v1",
+        concurrency=4,
+        composite_threshold=40,
+    )
+
+    assert parts == {
+        "project/v1/model.bin.velo-part-00": b"0123456789012",
+        "project/v1/model.bin.velo-part-01": b"3456789012345",
+        "project/v1/model.bin.velo-part-02": b"6789012345678",
+        "project/v1/model.bin.velo-part-03": b"90123456789",
+    }
+    deleted = storage_bucket.delete_blobs.call_args.args[0]
+    assert [b.name for b in deleted] == sorted(parts)
+
+
+class FakeResumableTransport:
+    """Answers the requests of resumable uploads, keeping the uploaded data."""
+
+    is_mtls = False
+
+    def __init__(self):
+        self.uploads = {}
+
+    def request(self, method, url, data=None, **_):
+        response = requests.Response()
+        response.status_code = 200
+        if method == "POST":
+            name = json.loads(data)["name"]
+            response.headers["location"] = f"https://upload/{name}"
+            self.uploads[name] = b""
+            return response
+        name = url.removeprefix("https://upload/")
+        self.uploads[name] += data
+        checksum = google_crc32c.Checksum(self.uploads[name]).digest()
+        response._content = json.dumps(  # pylint: disable=protected-access
+            {
+                "name": name,
+                "size": str(len(self.uploads[name])),
+                "crc32c": base64.b64encode(checksum).decode("ascii"),
+            }
+        ).encode()
+        return response
+
+
+def test_upload_from_directory_composes_parts_with_resumable_uploads(
+    deploy_folder, storage_bucket
+):
+    # Parts over 8 MiB are sent as resumable uploads, which need the stream of
+    # each part to start at position 0.
+    part_size = 8 * 1024 * 1024 + 1
+    data = os.urandom(2 * part_size)
+    (deploy_folder / "model.bin").write_bytes(data)
+    transport = FakeResumableTransport()
+    client = storage.Client(project="project", credentials=AnonymousCredentials())
+    client._http_internal = transport  # pylint: disable=protected-access
+    bucket = client.bucket("bucket")
+
+    composed = MagicMock()
+    composed.name = "project/v1/model.bin"
+    storage_bucket.blob.side_effect = lambda name: (
+        bucket.blob(name) if ".velo-part-" in name else composed
+    )
+
+    GCP("project").upload_from_directory(
+        path=deploy_folder,
+        dest_bucket_name="bucket",
+        dest_blob_name="project/v1",
+        concurrency=2,
+        composite_threshold=part_size,
+    )
+
+    assert sorted(transport.uploads) == [
+        "project/v1/model.bin.velo-part-00",
+        "project/v1/model.bin.velo-part-01",
+    ]
+    assert transport.uploads["project/v1/model.bin.velo-part-00"] == data[:part_size]
+    assert transport.uploads["project/v1/model.bin.velo-part-01"] == data[part_size:]
+    composed.compose.assert_called_once()
+
+
+def test_upload_from_directory_shares_concurrency_with_parts(
+    deploy_folder, storage_bucket
+):
+    (deploy_folder / "model.bin").write_bytes(b"0" * 50)
+    (deploy_folder / "data.bin").write_bytes(b"1" * 50)
+    lock = threading.Lock()
+    in_flight = []
+    most_in_flight = []
+
+    def request(*_args, **_kwargs):
+        with lock:
+            in_flight.append(1)
+            most_in_flight.append(len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.pop()
+
+    storage_bucket.blob.return_value.upload_from_file.side_effect = request
+    storage_bucket.blob.return_value.upload_from_filename.side_effect = request
+
+    GCP("project").upload_from_directory(
+        path=deploy_folder,
+        dest_bucket_name="bucket",
+        dest_blob_name="project/v1",
+        concurrency=2,
+        composite_threshold=40,
+    )
+
+    assert max(most_in_flight) <= 2
+
+
+def test_lookup_many_resolves_secrets_concurrently():
+    # Every lookup waits for the others, which only passes if all three run at
+    # the same time.
+    barrier = threading.Barrier(3, timeout=5)
+
+    def lookup_data(key, project_id, **_):
+        barrier.wait()
+        return f"{project_id}/{key}"
+
+    gcloud = GCP("project")
+    with (
+        patch.object(GCP, "_get_secrets_client"),
+        patch.object(gcloud, "lookup_data", side_effect=lookup_data),
+    ):
+        secrets = gcloud.lookup_many(["server", "api_key", "bucket", "server"], "velo")
+
+    assert secrets == {
+        "server": "velo/server",
+        "api_key": "velo/api_key",
+        "bucket": "velo/bucket",
+    }
+
+
+class FakeSecretsClient:
+    """Secret Manager client with many versions, paged like the real API."""
+
+    page_size = 25
+
+    def __init__(self, versions=200, disabled=()):
+        self.versions = versions
+        self.disabled = set(disabled)
+        self.requests = 0
+        self.filters = []
+
+    @staticmethod
+    def secret_path(project_id, key):
+        return f"projects/{project_id}/secrets/{key}"
+
+    def list_secret_versions(self, request):
+        self.filters.append(request.get("filter"))
+        for page_start in range(self.versions, 0, -self.page_size):
+            self.requests += 1
+            for number in range(page_start, max(page_start - self.page_size, 0), -1):
+                if request.get("filter") == "state:ENABLED" and number in self.disabled:
+                    continue
+                yield SimpleNamespace(name=f"{request['parent']}/versions/{number}")
+
+    def access_secret_version(self, request):
+        self.requests += 1
+        version = request["name"].split("/")[-1]
+        if version == LATEST_SECRET_VERSION:
+            version = str(self.versions)
+        if int(version) in self.disabled:
+            raise FailedPrecondition(f"Secret version {version} is disabled")
+        return MagicMock(**{"payload.data": f"secret-{version}".encode()})
+
+
+@pytest.mark.parametrize("enabled_only", [False, True])
+def test_lookup_data_latest_vs_listing(enabled_only):
+    """Count the requests of the 'latest' alias against listing all versions."""
+    secrets_client = FakeSecretsClient()
+
+    gcloud = GCP("project")
+    with patch.object(GCP, "_get_secrets_client", return_value=secrets_client):
+        secret = gcloud.lookup_data("key", "project", enabled_only=enabled_only)
+
+    assert secret == "secret-200"
+    if enabled_only:
+        # 8 pages of versions and the access of the highest enabled one
+        assert secrets_client.requests == 9
+    else:
+        assert secrets_client.requests == 1
+
+
+def test_lookup_data_falls_back_to_highest_enabled_version():
+    secrets_client = FakeSecretsClient(disabled={200})
+
+    gcloud = GCP("project")
+    with patch.object(GCP, "_get_secrets_client", return_value=secrets_client):
+        secret = gcloud.lookup_data("key", "project")
+
+    assert secret == "secret-199"
+    assert secrets_client.filters == ["state:ENABLED"]
+    # The failed 'latest' access, 8 pages of versions and the fallback access
+    assert secrets_client.requests == 10
@@ -2,7 +2,11 @@
 import os
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from unittest.mock import Mock
 
+import pytest
+
+from velo_action import main
 from velo_action.main import VELO_DEPLOY_FOLDER_NAME, action
 
 
@@ -22,3 +26,28 @@ def test_generate_version_no_inputs(
             github_settings=default_github_settings,
         )
         assert output.version == "1af9c7c"
+
+
+def test_client_is_closed_when_a_phase_fails(
+    monkeypatch, default_action_inputs, default_github_settings
+):
+    # The action changes into the workspace, restore the directory afterwards
+    monkeypatch.chdir(os.getcwd())
+    octo = Mock()
+    monkeypatch.setattr(main, "lookup_secrets", lambda args: (None, {}))
+    monkeypatch.setattr(main, "create_client", lambda args, secrets: octo)
+    monkeypatch.setattr(main, "deploy", Mock(side_effect=RuntimeError("Failed")))
+
+    with TemporaryDirectory() as tempdir:
+        deploy_folder = Path(tempdir).joinpath(VELO_DEPLOY_FOLDER_NAME)
+        os.mkdir(deploy_folder)
+        deploy_folder.joinpath("app.yml").write_text(
+            "project: test\n", encoding="utf-8"
+        )
+        default_action_inputs.workspace = tempdir
+        default_action_inputs.deploy_to_environments = ["staging"]
+
+        with pytest.raises(RuntimeError, match="Failed"):
+            action(args=default_action_inputs, github_settings=default_github_settings)
+
+    octo.close.assert_called_once()
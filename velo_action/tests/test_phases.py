@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+from velo_action.phases import PhaseGraph
+
+
+def test_phases_receive_results_of_required_phases():
+    graph = PhaseGraph()
+    graph.add("one", lambda: 1)
+    graph.add("two", lambda: 2)
+    graph.add("sum", lambda one, two: one + two, requires=["one", "two"])
+
+    assert graph.run() == {"one": 1, "two": 2, "sum": 3}
+    assert set(graph.timings) == {"one", "two", "sum"}
+    assert graph.timings["sum"].started >= graph.timings["one"].finished
+    assert graph.timings["sum"].seconds >= 0
+
+
+def test_independent_phases_run_concurrently():
+    both_started = threading.Barrier(2, timeout=5)
+    graph = PhaseGraph(max_workers=2)
+    graph.add("trace", both_started.wait)
+    graph.add("secrets", both_started.wait)
+
+    graph.run()
+
+
+def test_failing_phase_cancels_phases_not_started():
+    ran = []
+
+    def fail():
+        raise RuntimeError("No secrets")
+
+    graph = PhaseGraph()
+    graph.add("secrets", fail)
+    graph.add("client", lambda _: ran.append("client"), requires=["secrets"])
+    graph.add("trace", lambda: ran.append("trace"))
+
+    with pytest.raises(RuntimeError, match="No secrets"):
+        graph.run()
+    assert ran == ["trace"]
+    assert "client" not in graph.timings
+
+
+def test_phase_requires_known_phases():
+    graph = PhaseGraph()
+    with pytest.raises(ValueError, match="unknown phases"):
+        graph.add("client", lambda _: None, requires=["secrets"])
@@ -0,0 +1,72 @@
+# pylint: disable=redefined-outer-name
+import base64
+import json
+from unittest.mock import patch
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from velo_action.tokens import TokenProvider, token_provider
+
+
+@pytest.fixture(scope="module")
+def private_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+@pytest.fixture(scope="module")
+def service_account(private_key):
+    pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption(),
+    )
+    return {
+        "client_email": "velo@project.iam.gserviceaccount.com",
+        "private_key_id": "key-1",
+        "private_key": pem.decode("ascii"),
+    }
+
+
+def test_token_is_signed_for_audience(private_key, service_account):
+    token = TokenProvider(service_account).token("https://octopus/")
+
+    claims = jwt.decode(
+        token,
+        private_key.public_key(),
+        algorithms=["RS256"],
+        audience="https://octopus/",
+    )
+    assert claims["iss"] == claims["email"] == service_account["client_email"]
+    assert jwt.get_unverified_header(token)["kid"] == "key-1"
+
+
+def test_token_is_cached_per_audience(service_account):
+    tokens = TokenProvider(service_account)
+
+    with patch("velo_action.tokens.jwt.encode", wraps=jwt.encode) as encode:
+        first = tokens.token("https://octopus/")
+        assert tokens.token("https://octopus/") == first
+        assert tokens.token("tracing") != first
+    assert encode.call_count == 2
+
+
+def test_token_is_refreshed_before_expiry(service_account):
+    tokens = TokenProvider(service_account, lifetime=3600, refresh_margin=300)
+
+    with patch("velo_action.tokens.time.time", return_value=1000):
+        first = tokens.token("https://octopus/")
+    with patch("velo_action.tokens.time.time", return_value=1000 + 3000):
+        assert tokens.token("https://octopus/") == first
+    with patch("velo_action.tokens.time.time", return_value=1000 + 3300):
+        assert tokens.token("https://octopus/") != first
+
+
+def test_token_provider_is_shared(service_account):
+    key = json.dumps(service_account)
+    encoded = base64.b64encode(key.encode("ascii")).decode("ascii")
+
+    assert token_provider(key) is token_provider(key)
+    assert token_provider(encoded).email == service_account["client_email"]
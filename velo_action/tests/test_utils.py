@@ -7,6 +7,8 @@ from semantic_version import SimpleSpec, Version
 
 from velo_action.utils import (
     find_matching_version,
+    is_ignored,
+    iter_deploy_files,
     read_field_from_app_spec,
     read_velo_settings,
 )
@@ -106,3 +108,72 @@ def test_read_field_from_app_spec_failure():
     with pytest.raises(ValueError):
         with patch("builtins.open", mock_open(read_data="project: test")):
             read_field_from_app_spec(field="not_present", filename=Path("/mocked"))
+
+
+@pytest.mark.parametrize(
+    "path,is_dir,patterns,ignored",
+    [
+        ("app.yml", False, ["*.log"], False),
+        ("k8s/debug.log", False, ["*.log"], True),
+        ("k8s/tmp", True, ["tmp/"], True),
+        ("k8s/tmp", False, ["tmp/"], False),
+        ("k8s/app.yml", False, ["/app.yml"], False),
+        ("app.yml", False, ["/app.yml"], True),
+        ("k8s/keep.log", False, ["*.log", "!keep.log"], False),
+        ("k8s/app.yml", False, ["k8s/*.yml"], True),
+        ("k8s/x/app.yml", False, ["k8s/*.yml"], False),
+        ("k8s/x/app.yml", False, ["k8s/**/*.yml"], True),
+        ("k8s/app.yml", False, ["k8s/**/*.yml"], True),
+        ("k8s/x/app.yml", False, ["**/app.yml"], True),
+        ("k8s/x/app.yml", False, ["k8s/**"], True),
+        ("tmp/keep.yml", False, ["tmp/*", "!tmp/keep.yml"], False),
+        ("tmp/other.yml", False, ["tmp/*", "!tmp/keep.yml"], True),
+    ],
+)
+def test_is_ignored(path, is_dir, patterns, ignored):
+    assert is_ignored(path, is_dir, patterns) is ignored
+
+
+def test_iter_deploy_files_honors_veloignore():
+    with TemporaryDirectory() as tmpdir:
+        folder = Path(tmpdir)
+        (folder / ".veloignore").write_text("# comment\n*.log\n", encoding="utf-8")
+        (folder / "app.yml").write_text("project: test\n", encoding="utf-8")
+        (folder / "debug.log").write_text("log", encoding="utf-8")
+        (folder / ".app.yml.swp").write_text("swap", encoding="utf-8")
+        (folder / "__pycache__").mkdir()
+        (folder / "__pycache__" / "render.cpython-310.pyc").write_bytes(b"")
+        (folder / "k8s").mkdir()
+        (folder / "k8s" / "deployment.yml").write_text("kind: x\n", encoding="utf-8")
+
+        files = list(iter_deploy_files(folder))
+
+    assert [(f.relative_path, f.size) for f in files] == [
+        ("app.yml", 14),
+        ("k8s/deployment.yml", 8),
+    ]
+
+
+def test_iter_deploy_files_skips_symlinked_directories():
+    with TemporaryDirectory() as tmpdir:
+        folder = Path(tmpdir)
+        (folder / "a").mkdir()
+        (folder / "a" / "app.yml").write_text("project: test\n", encoding="utf-8")
+        (folder / "a" / "loop").symlink_to("..")
+
+        files = list(iter_deploy_files(folder))
+
+    assert [f.relative_path for f in files] == ["a/app.yml"]
+
+
+def test_iter_deploy_files_reincludes_file_in_ignored_folder_contents():
+    with TemporaryDirectory() as tmpdir:
+        folder = Path(tmpdir)
+        (folder / ".veloignore").write_text("tmp/*\n!tmp/keep.yml\n", encoding="utf-8")
+        (folder / "tmp").mkdir()
+        (folder / "tmp" / "keep.yml").write_text("keep", encoding="utf-8")
+        (folder / "tmp" / "scratch.yml").write_text("scratch", encoding="utf-8")
+
+        files = list(iter_deploy_files(folder))
+
+    assert [f.relative_path for f in files] == ["tmp/keep.yml"]
@@ -0,0 +1,86 @@
+import base64
+import binascii
+import json
+import threading
+import time
+from functools import lru_cache
+from typing import Any
+
+import jwt
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+
+TOKEN_LIFETIME_SECONDS = 3600
+# Tokens are signed again when they expire within this many seconds
+REFRESH_MARGIN_SECONDS = 300
+# Backdate tokens to tolerate a clock difference with the receiving server
+CLOCK_SKEW_SECONDS = 10
+
+
+class TokenProvider:  # pylint: disable=too-few-public-methods
+    """
+    Self-signed JWTs of a Google service account, cached per audience
+
+    The private key is parsed once. Tokens are signed again shortly before
+    they expire, so callers asking for a token per request never send an
+    expired one.
+    """
+
+    def __init__(
+        self,
+        service_account: dict,
+        lifetime=TOKEN_LIFETIME_SECONDS,
+        refresh_margin=REFRESH_MARGIN_SECONDS,
+    ):
+        self.email = service_account["client_email"]
+        self.key_id = service_account["private_key_id"]
+        self.lifetime = lifetime
+        self.refresh_margin = refresh_margin
+        # PyJWT signs with a parsed key too, although it is annotated as str
+        self._private_key: Any = load_pem_private_key(
+            service_account["private_key"].encode("ascii"), password=None
+        )
+        self._tokens: dict = {}  # audience -> (token, expires_at)
+        self._lock = threading.Lock()
+
+    def token(self, audience) -> str:
+        with self._lock:
+            now = time.time()
+            cached = self._tokens.get(audience)
+            if cached is not None and cached[1] - self.refresh_margin > now:
+                return cached[0]
+
+            issued_at = now - CLOCK_SKEW_SECONDS
+            expires_at = issued_at + self.lifetime
+            payload = {
+                "email": self.email,
+                "iss": self.email,
+                "sub": self.email,
+                "aud": audience,
+                "iat": issued_at,
+                "exp": expires_at,
+            }
+            token = jwt.encode(
+                payload,
+                self._private_key,
+                headers={"kid": self.key_id},
+                algorithm="RS256",
+            )
+            self._tokens[audience] = (token, expires_at)
+            return token
+
+
+@lru_cache(maxsize=8)
+def token_provider(service_account_key: str) -> TokenProvider:
+    """
+    Shared TokenProvider of a service account key, given as JSON or as
+    base64 encoded JSON
+    """
+    try:
+        service_account = json.loads(service_account_key)
+    except ValueError:
+        try:
+            decoded = base64.b64decode(service_account_key.encode("ascii"))
+        except (binascii.Error, UnicodeEncodeError) as err:
+            raise ValueError("Service account key is neither JSON nor base64") from err
+        service_account = json.loads(decoded.decode("ascii"))
+    return TokenProvider(service_account)
@@ -1,11 +1,7 @@
-import base64
 import datetime as dt
-import json
 import os
-import time
 from typing import Any
 
-import jwt
 import pydantic
 from loguru import logger
 from opentelemetry import trace
@@ -23,6 +19,9 @@ from opentelemetry.trace.status import Status, StatusCode
 
 from velo_action.github import request_github_workflow_data
 from velo_action.settings import GRAFANA_URL, ActionInputs, GithubSettings
+from velo_action.tokens import token_provider
+
+TRACING_AUDIENCE = "some-cool-internally-nube-app-endpoint"
 
 
 def init_tracer(
@@ -50,23 +49,8 @@ def init_tracer(
             ),
         ]
     else:
-        jwt_content = json.loads(base64.b64decode(args.service_account_key).decode("ascii"))  # type: ignore
-        iat = time.time() - 10
-        exp = iat + 3600
-        payload = {
-            "iss": jwt_content["client_email"],
-            "sub": jwt_content["client_email"],
-            "aud": "some-cool-internally-nube-app-endpoint",
-            "email": jwt_content["client_email"],
-            "iat": iat,
-            "exp": exp,
-        }
-        additional_headers = {"kid": jwt_content["private_key_id"]}
-        signed_jwt = jwt.encode(
-            payload,
-            jwt_content["private_key"],
-            headers=additional_headers,
-            algorithm="RS256",
+        signed_jwt = token_provider(args.service_account_key).token(  # type: ignore
+            TRACING_AUDIENCE
         )
         headers = {"Authorization": f"Bearer {signed_jwt}"}
 
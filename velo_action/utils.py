@@ -1,10 +1,11 @@
 import os
-import time
 import json
-import jwt
+import re
+from fnmatch import fnmatch
+from functools import lru_cache
 from pathlib import Path
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterator, List, NamedTuple, Optional, Pattern
 
 from semantic_version import SimpleSpec, Version
 
@@ -13,6 +14,25 @@ from velo_action.settings import (
     APP_SPEC_FILENAMES,
     VeloSettings,
 )
+from velo_action.tokens import token_provider
+
+VELO_IGNORE_FILENAME = ".veloignore"
+
+# Always ignored unless negated in the .veloignore file
+DEFAULT_IGNORE_PATTERNS = [
+    VELO_IGNORE_FILENAME,
+    "__pycache__/",
+    "*.py[co]",
+    "*.sw[op]",
+    "*~",
+    ".DS_Store",
+]
+
+
+class DeployFile(NamedTuple):
+    path: str
+    relative_path: str
+    size: int
 
 
 def resolve_app_spec_filename(deploy_folder: Path) -> Path:
@@ -62,6 +82,95 @@ def read_field_from_app_spec(field: str, filename: Path) -> str:
     raise ValueError(f"Could not find '{field}' in {filename}")
 
 
+def read_ignore_patterns(deploy_folder: Path) -> List[str]:
+    """Read the gitignore-style patterns from the .veloignore file, if any."""
+    patterns = list(DEFAULT_IGNORE_PATTERNS)
+    ignore_file = Path.joinpath(deploy_folder, VELO_IGNORE_FILENAME)
+    if ignore_file.is_file():
+        for line in read_file(ignore_file).splitlines():
+            line = line.strip()
+            if line and not line.startswith("#"):
+                patterns.append(line)
+    return patterns
+
+
+@lru_cache(maxsize=256)
+def _anchored_pattern(pattern: str) -> Pattern:
+    """Translate an anchored gitignore pattern, where only '**' crosses a '/'."""
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2 :]:
+            end = pattern.index("]", i + 2)
+            regex += "[" + pattern[i + 1 : end].replace("!", "^", 1) + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + r"\Z")
+
+
+def is_ignored(relative_path: str, is_dir: bool, patterns: List[str]) -> bool:
+    """Match a path relative to the deploy folder against gitignore-style patterns.
+
+    Supports negation with '!', directory-only patterns with a trailing '/' and
+    patterns anchored to the deploy folder when they contain a '/'. In anchored
+    patterns '*' does not match a '/', while '**' matches any number of folders.
+    The last matching pattern wins.
+    """
+    ignored = False
+    name = relative_path.rsplit("/", 1)[-1]
+    for pattern in patterns:
+        negate = pattern.startswith("!")
+        pattern = pattern.lstrip("!")
+        if pattern.endswith("/"):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip("/")
+        if "/" in pattern:
+            matched = bool(_anchored_pattern(pattern.lstrip("/")).match(relative_path))
+        else:
+            matched = fnmatch(name, pattern)
+        if matched:
+            ignored = not negate
+    return ignored
+
+
+def iter_deploy_files(deploy_folder: Path) -> Iterator[DeployFile]:
+    """Yield the files in the deploy folder as they are discovered.
+
+    Uses os.scandir so the file type and size come from the directory listing
+    without extra stat calls. Ignored directories and symlinks to directories
+    are not descended into.
+    """
+    patterns = read_ignore_patterns(deploy_folder)
+    directories = [(str(deploy_folder), "")]
+    while directories:
+        directory, relative_directory = directories.pop()
+        with os.scandir(directory) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                relative_path = relative_directory + entry.name
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if is_ignored(relative_path, is_dir, patterns):
+                    continue
+                if is_dir:
+                    directories.append((entry.path, relative_path + "/"))
+                elif entry.is_file():
+                    yield DeployFile(entry.path, relative_path, entry.stat().st_size)
+
+
 def find_matching_version(
     versions: List[str], version_to_match: SimpleSpec
 ) -> Optional[Version]:
@@ -75,29 +184,7 @@ def find_matching_version(
 
 
 def create_self_signed_jwt(jwt_content, url):
-
-    gsa = json.loads(jwt_content)
-
-    iat = time.time()
-    exp = iat + 3600
-    payload = {
-        "email": gsa["client_email"],
-        "iss": gsa["client_email"],
-        "sub": gsa["client_email"],
-        "aud": url,
-        "iat": iat,
-        "exp": exp,
-    }
-    additional_headers = {"kid": gsa["private_key_id"]}
-
-    signed_jwt = jwt.encode(
-        payload,
-        gsa["private_key"],
-        headers=additional_headers,
-        algorithm="RS256",
-    )
-
-    return signed_jwt
+    return token_provider(jwt_content).token(url)
 
 
 def is_valid_gsa_json(gsa_token_json):